@@ -1,28 +1,59 @@
 import pandas as pd
 import numpy as np
 import math
+import os
+import shutil
+import tempfile
+import timeit
 import collections
+import collections.abc
+import warnings
 
-import seaborn as sn
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import cm
-import matplotlib.ticker as mticker
+from . import lazy_utils
+#Plotting, statsmodels, scipy and sklearn are imported on first use (see lazy_utils)
+sn = lazy_utils.lazy_import('seaborn')
+plt = lazy_utils.lazy_import('matplotlib.pyplot')
+cm = lazy_utils.lazy_import('matplotlib.cm')
+LineCollection = lazy_utils.lazy_import('matplotlib.collections', 'LineCollection')
+mticker = lazy_utils.lazy_import('matplotlib.ticker')
 
-import statsmodels.api as sm
-import statsmodels.formula.api as smf
-from statsmodels.tsa.api import VAR
-from statsmodels.tsa.stattools import adfuller
-from statsmodels.graphics.tsaplots import pacf, plot_pacf
-from scipy.stats import pearsonr
+sm = lazy_utils.lazy_import('statsmodels.api')
+smf = lazy_utils.lazy_import('statsmodels.formula.api')
+dmatrices = lazy_utils.lazy_import('patsy', 'dmatrices')
+VAR = lazy_utils.lazy_import('statsmodels.tsa.api', 'VAR')
+adfuller = lazy_utils.lazy_import('statsmodels.tsa.stattools', 'adfuller')
+kpss = lazy_utils.lazy_import('statsmodels.tsa.stattools', 'kpss')
+pearsonr = lazy_utils.lazy_import('scipy.stats', 'pearsonr')
+norm = lazy_utils.lazy_import('scipy.stats', 'norm')
+chi2 = lazy_utils.lazy_import('scipy.stats', 'chi2')
+student_t = lazy_utils.lazy_import('scipy.stats', 't')
 
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import accuracy_score
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.impute import IterativeImputer, KNNImputer
+LogisticRegression = lazy_utils.lazy_import('sklearn.linear_model', 'LogisticRegression')
+accuracy_score = lazy_utils.lazy_import('sklearn.metrics', 'accuracy_score')
+#Importing IterativeImputer from enable_iterative_imputer also enables it in sklearn.impute
+IterativeImputer = lazy_utils.lazy_import('sklearn.experimental.enable_iterative_imputer', 'IterativeImputer')
+KNNImputer = lazy_utils.lazy_import('sklearn.impute', 'KNNImputer')
 
 from datetime import timedelta
 
 from . import data_utils
+from . import cache_utils
+from . import parallel_utils
+
+
+#Messages are printed (for notebooks) unless a logger is set with set_logger:
+#set_logger(logging.getLogger(...)) sends them to a logger, set_logger(False) drops them
+message_logger = None
+
+def set_logger(logger):
+    global message_logger
+    message_logger = logger
+
+def log(message=''):
+    if message_logger is None:
+        print(message)
+    elif message_logger is not False:
+        message_logger.info('%s', message)
 
 
 def process_morning_survey(df, b_intrinsic=True, b_categorical=False):
@@ -111,7 +142,7 @@ def process_activity_logs(df, column_names=None, b_check_exceeded=True):
         df_individual['Exceed Day'] = df_individual['With Overlap'] < df_individual['Start Time']
         if b_check_exceeded:
             if df_individual['Exceed Day'].any() == True:
-                print('participant ', participant, 'activity duration exceeded day')
+                log('participant %s activity duration exceeded day' % participant)
         #Build daily frame: sum up all activity durations
         df_individual['Activity Duration'] = df_individual['Activity Duration'].astype(int)
         df_individual = df_individual[['Date', 'Activity Duration', 'Start Time']]        
@@ -129,26 +160,28 @@ def process_activity_logs(df, column_names=None, b_check_exceeded=True):
     df_activity.name = 'Activity Logs'
     return df_activity
 
-def get_score_mapping(df_score):
+def get_score_table(df_score):
+    #Score table indexed by Subject ID, with the IDs normalized to strings once
+    #(the last row wins if a Subject ID appears more than once)
     df_score = df_score.rename(columns={'study_id':'Subject ID'})
-    score_mapping = {}
-    for score_name in list(df_score.columns):
-        if score_name != 'Subject ID':
-            score_mapping[score_name] = {}
-            for i, subject_id in enumerate(df_score['Subject ID'].values):
-                score_mapping[score_name][str(subject_id)] = df_score[score_name][i]
-    return score_mapping
+    df_score = df_score.assign(**{'Subject ID': df_score['Subject ID'].astype(str)})
+    df_score = df_score.drop_duplicates(subset='Subject ID', keep='last')
+    return df_score.set_index('Subject ID')
+
+def get_score_mapping(df_score):
+    return get_score_table(df_score).to_dict()
 
 def combine_with_score(df1, df_score, b_display_mapping=False):
-    score_mapping = get_score_mapping(df_score)
+    #Attach all baseline scores (TIPI, BREQ-2, IPAQ...) with a single left join on Subject ID
+    df_score = get_score_table(df_score)
     if b_display_mapping:
-        for k,v in score_mapping.items():
-            print(k, '->', v, '\n')
-    df_combined = df1.copy()
-    df_combined = df_combined.reset_index()
-    for score_name in score_mapping:
-        participants = list(score_mapping[score_name].keys())
-        df_combined[score_name] = df_combined['Subject ID'].map(lambda x: score_mapping[score_name][str(x)] if str(x) in participants else np.NaN)
+        for k,v in df_score.to_dict().items():
+            log('%s -> %s\n' % (k, v))
+    df_combined = df1.reset_index()
+    df_combined = df_combined.drop(columns=[x for x in df_score.columns if x in df_combined.columns])
+    df_combined['Score Key'] = df_combined['Subject ID'].astype(str)
+    df_combined = df_combined.merge(df_score, how='left', left_on='Score Key', right_index=True)
+    df_combined = df_combined.drop(columns=['Score Key'])
     df_combined = df_combined.set_index(['Subject ID','Date'])
     return df_combined
 
@@ -160,7 +193,7 @@ def concatenate_mood_fitbit_minute(df1, df_fitbit, participant):
     df1['Date'] = pd.to_datetime(df1['Date'])
     df_fitbit['Date'] = pd.to_datetime(df_fitbit['Date'])
     start_date = df1['Date'].min()
-    print('combined start_date =', start_date)
+    log('combined start_date = %s' % start_date)
     df1 = df1[df1['Date'] >= start_date]
     df_fitbit = df_fitbit[df_fitbit['Date'] >= start_date]
     df1 = df1.set_index(['Date'])
@@ -177,43 +210,130 @@ def convert_column_to_binary(df, column_name):
     df[column_name] = df[column_name].apply(lambda x: 1 if x > 0 else 0)
     return df
 
-def plot_time_series(df, y_name, subject_names):
-    #Plot time series for subjects in subject_names
+def get_time_series_matrix(df, y_name, subject_names=None):
+    #(study day x participant) matrix of y_name, where study day counts the complete days
+    #of each participant (rows with missing values are dropped, as in plot_time_series)
     df = df.dropna()
     df = df.replace({True: 1, False: 0})
-    #Check if the subject name exists in the data
-    participants = get_subject_ids(df)
+    if subject_names:
+        df = df[df.index.get_level_values('Subject ID').isin(subject_names)]
+    participant_ids = df.index.get_level_values('Subject ID')
+    df_long = pd.DataFrame({'Study Day':df.groupby(level='Subject ID', sort=False).cumcount().to_numpy(),
+                            'Subject ID':participant_ids, y_name:df[y_name].to_numpy(dtype=float)})
+    df_matrix = df_long.pivot(index='Study Day', columns='Subject ID', values=y_name)
+    return df_matrix[pd.unique(participant_ids)]
+
+def plot_time_series(df, y_name, subject_names, b_plot=True):
+    #Plot time series for subjects in subject_names, with the mean per study day
+    #Returns the (study day x participant) matrix; b_plot = False only computes it
+    participants = data_utils.get_subject_ids(df)
     for subject_id in subject_names:
         if subject_id not in participants:
-            print('cannot find Participant ID =', subject_id)
-            subject_names.remove(subject_id)
-    if len(subject_names) > 1:
-        df = df.loc[subject_names,:]
-    subjects = list(df.index)
-    #Plot time series, with mean per day
+            log('cannot find Participant ID = %s' % subject_id)
+    subject_names = [subject_id for subject_id in subject_names if subject_id in participants]
+    df_matrix = get_time_series_matrix(df, y_name, subject_names)
+    if not b_plot:
+        return df_matrix
+    values = df_matrix.to_numpy()
+    xs = np.arange(values.shape[0])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        ys = np.nanmean(values, axis=1)
     plt.figure(figsize=(12,2))
-    all_steps = collections.defaultdict(list)
-    previous = ''
-    for value in subjects:
-        subject_id = value[0]
-        date = value[1]
-        step = df.loc[subject_id, date][y_name]        
-        if previous != subject_id:
-            previous = subject_id
-            steps = list(df.loc[subject_id,:][y_name])
-            for pos, num in enumerate(steps):
-                all_steps[pos].append(num)
-            label = subject_id if len(subject_names) < 10 else ''
-            plt.plot(steps, label=label)
-    xs = list(all_steps.keys())
-    ys = [np.mean(steps) for steps in list(all_steps.values())]
-    plt.plot(xs, ys, ls=':', lw=2, label='mean', color='black')
+    ax = plt.gca()
+    if values.shape[1] < 10:
+        for subject_id in df_matrix.columns:
+            ax.plot(xs, df_matrix[subject_id].to_numpy(), label=subject_id)
+    else:
+        colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        segments = [np.column_stack([xs, values[:,j]])[~np.isnan(values[:,j])] for j in range(values.shape[1])]
+        ax.add_collection(LineCollection(segments, colors=colors, linewidths=1.5))
+        ax.autoscale_view()
+    ax.plot(xs, ys, ls=':', lw=2, label='mean', color='black')
     plt.legend(loc=2, fontsize=8)
     plt.ylabel(y_name)
     plt.xlabel('Number of days')
     plt.title(y_name)
+    return df_matrix
+
+def run_stationarity_tests_participant(values, names, lags, b_kpss):
+    #ADF (H0: unit root) and optionally KPSS (H0: stationary) tests of each column of values
+    #lags[j] is the ADF lag to reuse for column j, or None to select it with AIC
+    rows = []
+    for j, name in enumerate(names):
+        x = values[:, j]
+        row = {'Variable':name, 'n':len(x)}
+        try:
+            if lags[j] is None:
+                adf_test = adfuller(x, autolag='AIC')
+            else:
+                adf_test = adfuller(x, maxlag=int(lags[j]), autolag=None)
+            row.update({'adf_stat':adf_test[0], 'adf_p_value':adf_test[1], 'adf_lags':adf_test[2],
+                        'adf_critical_5%':adf_test[4]['5%']})
+        except (ValueError, np.linalg.LinAlgError):
+            row.update({'adf_stat':np.nan, 'adf_p_value':np.nan, 'adf_lags':np.nan, 'adf_critical_5%':np.nan})
+        if b_kpss:
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    kpss_test = kpss(x, regression='c', nlags='auto')
+                row.update({'kpss_stat':kpss_test[0], 'kpss_p_value':kpss_test[1], 'kpss_lags':kpss_test[2]})
+            except (ValueError, np.linalg.LinAlgError, OverflowError):
+                row.update({'kpss_stat':np.nan, 'kpss_p_value':np.nan, 'kpss_lags':np.nan})
+        rows.append(row)
+    return rows
+
+def compute_stationarity(df, names, b_kpss=False, alpha=0.05, lags=None, n_jobs=1):
+    #ADF (and optionally KPSS) test for every (participant, variable) series, in a worker pool
+    #Rows with missing values are dropped (as in check_stationary) and rows are consecutive days
+    #lags: None selects the ADF lag by AIC, an int fixes it, and a previous result table reuses its
+    #selected lags (for example to add KPSS or to rerun on more days without a new lag search)
+    #Return a table indexed by (Subject ID, Variable) with statistics, p-values and decisions at alpha
+    df = df[names].dropna()
+    df = df.replace({True: 1, False: 0})
+    df = df.sort_index(level=[0, 1])
+    values = df.to_numpy(dtype=float)
+    blocks = get_participant_blocks(df)
+    jobs = []
+    for participant_id, start, stop in blocks:
+        if isinstance(lags, pd.DataFrame):
+            participant_lags = [lags['adf_lags'].get((participant_id, name), np.nan) for name in names]
+            participant_lags = [None if pd.isna(lag) else lag for lag in participant_lags]
+        else:
+            participant_lags = [lags] * len(names)
+        jobs.append((values[start:stop], names, participant_lags, b_kpss))
+    results = parallel_utils.run_parallel(run_stationarity_tests_participant, jobs, n_jobs)
+    rows = []
+    for (participant_id, _, _), participant_rows in zip(blocks, results):
+        for row in participant_rows:
+            row['Subject ID'] = participant_id
+            rows.append(row)
+    columns = ['n', 'adf_stat', 'adf_p_value', 'adf_lags', 'adf_critical_5%']
+    if b_kpss:
+        columns += ['kpss_stat', 'kpss_p_value', 'kpss_lags']
+    df_tests = pd.DataFrame(rows, columns=['Subject ID', 'Variable'] + columns).set_index(['Subject ID', 'Variable'])
+    #ADF rejects a unit root, KPSS fails to reject stationarity
+    adf_stationary = df_tests['adf_p_value'] < alpha
+    df_tests['adf_stationary'] = adf_stationary
+    decision = np.where(adf_stationary, 'stationary', 'non-stationary')
+    if b_kpss:
+        kpss_stationary = df_tests['kpss_p_value'] >= alpha
+        df_tests['kpss_stationary'] = kpss_stationary
+        decision = np.where(adf_stationary == kpss_stationary, decision, 'inconclusive')
+        decision = np.where(df_tests['kpss_p_value'].isna(), 'undetermined', decision)
+    df_tests['decision'] = np.where(df_tests['adf_p_value'].isna(), 'undetermined', decision)
+    return df_tests
 
-def check_stationary(df, names):
+def check_stationary(df, names, b_panel=False, b_kpss=False, alpha=0.05, lags=None, n_jobs=1):
+    #b_panel = True tests every participant separately (see compute_stationarity), prints the
+    #number of participants per decision and returns the table; otherwise the rows of all
+    #participants are tested as one series
+    if b_panel:
+        df_tests = compute_stationarity(df, names, b_kpss, alpha, lags, n_jobs)
+        for name in names:
+            decisions = df_tests.xs(name, level='Variable')['decision'].value_counts()
+            log('%s: %s' % (name, ', '.join('%s = %d' % (k, v) for k, v in decisions.items())))
+        return df_tests
     df = df.dropna()
     df = df.replace({True: 1, False: 0})
     for name in names:
@@ -221,264 +341,1154 @@ def check_stationary(df, names):
         adf_stat = adf_test[0]
         p_value  = adf_test[1]
         critical_values = adf_test[4]
-        print('Check if %s is stationary?' % name)
-        print('ADF statistic = %f' % adf_stat)
-        print('p-value = %f' % p_value)
-        print('critical values:')
+        log('Check if %s is stationary?' % name)
+        log('ADF statistic = %f' % adf_stat)
+        log('p-value = %f' % p_value)
+        log('critical values:')
         for key, value in critical_values.items():
-            print('\t%s: %.3f' % (key, value))
+            log('\t%s: %.3f' % (key, value))
         # Ho: time series is non-stationary
         if adf_stat < critical_values['5%']: # reject Ho
-            print('%s time series is stationary' % name)             
+            log('%s time series is stationary' % name)             
         else: # failed to reject Ho
-            print('%s time series is non-stationary' % name)
-        print()
+            log('%s time series is non-stationary' % name)
+        log()
+
+def get_participant_blocks(df):
+    #Return (participant, start, stop) row blocks of a frame sorted by Subject ID
+    participant_ids = df.index.get_level_values(0)
+    if len(participant_ids) == 0:
+        return []
+    codes, uniques = pd.factorize(participant_ids)
+    starts = np.concatenate([[0], np.flatnonzero(codes[1:] != codes[:-1]) + 1])
+    stops  = np.concatenate([starts[1:], [len(codes)]])
+    return [(participant_ids[start], start, stop) for start, stop in zip(starts, stops)]
+
+class Panel:
+    #Dense (participants x days x variables) float32 array of a (Subject ID, Date) frame
+    #Days are the rows of each participant in date order (day t of two participants can be different
+    #dates, as in the rest of this module); values are NaN where mask is False (missing values and the
+    #padding after the last day of a participant), and dates[p, t] is the Date label of day t
+    def __init__(self, values, mask, lengths, participants, dates, variables):
+        self.values = values
+        self.mask = mask
+        self.lengths = np.asarray(lengths, dtype=int)
+        self.participants = np.asarray(participants, dtype=object)
+        self.dates = dates
+        self.variables = list(variables)
 
-def impute(df, methods):
+    @classmethod
+    def from_frame(cls, df, variables=None):
+        #Numeric and boolean columns (as 0/1) by default
+        df = df.replace({True: 1, False: 0})
+        if variables is None:
+            variables = list(df.infer_objects().select_dtypes(include=['number', 'bool']).columns)
+        df = df[variables].sort_index(level=[0, 1])
+        blocks = get_participant_blocks(df)
+        lengths = np.array([stop - start for _, start, stop in blocks], dtype=int)
+        n_days = lengths.max() if len(blocks) > 0 else 0
+        codes = np.repeat(np.arange(len(blocks)), lengths)
+        positions = np.arange(len(df)) - np.repeat([start for _, start, _ in blocks], lengths).astype(int)
+        values = np.full((len(blocks), n_days, len(variables)), np.nan, dtype=np.float32)
+        values[codes, positions] = df.to_numpy(dtype=float)
+        dates = np.full((len(blocks), n_days), None, dtype=object)
+        dates[codes, positions] = df.index.get_level_values(1).to_numpy(dtype=object)
+        return cls(values, ~np.isnan(values), lengths, [b[0] for b in blocks], dates, variables)
+
+    def to_frame(self):
+        codes, positions = np.nonzero(self.get_row_mask())
+        index = pd.MultiIndex.from_arrays([self.participants[codes], self.dates[codes, positions]],
+                                          names=['Subject ID', 'Date'])
+        return pd.DataFrame(self.values[codes, positions].astype(float), index=index, columns=self.variables)
+
+    def __len__(self):
+        return len(self.participants)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def get_row_mask(self):
+        #(participants x days) mask of the days that exist for each participant
+        return np.arange(self.values.shape[1]) < self.lengths[:, None]
+
+    def get_indices(self, names):
+        return np.array([self.variables.index(name) for name in names], dtype=int)
+
+    def get(self, names):
+        #float64 (participants x days) array of one variable, or (participants x days x variables) for a list
+        if isinstance(names, str):
+            return self.values[:, :, self.variables.index(names)].astype(float)
+        return self.values[:, :, self.get_indices(names)].astype(float)
+
+    def select(self, participants=None, variables=None):
+        #Panel restricted to some participants (in the order of this panel) and variables
+        rows = np.arange(len(self.participants))
+        if participants is not None:
+            rows = rows[np.isin(self.participants, list(participants))]
+        columns = np.arange(len(self.variables)) if variables is None else self.get_indices(variables)
+        grid = np.ix_(rows, np.arange(self.values.shape[1]), columns)
+        return Panel(self.values[grid], self.mask[grid], self.lengths[rows], self.participants[rows],
+                     self.dates[rows], [self.variables[j] for j in columns])
+
+    def rename(self, rename_dict):
+        #Panel with variables renamed as in DataFrame.rename(columns=rename_dict) (the arrays are shared)
+        return Panel(self.values, self.mask, self.lengths, self.participants, self.dates,
+                     [rename_dict.get(name, name) for name in self.variables])
+
+    def dropna(self):
+        #Panel without the days where any variable is missing (as DataFrame.dropna), days shifted to the front
+        complete = self.mask.all(axis=2) & self.get_row_mask()
+        lengths = complete.sum(axis=1)
+        rows = np.flatnonzero(lengths > 0)
+        complete, lengths = complete[rows], lengths[rows]
+        codes, positions = np.nonzero(complete)
+        new_positions = (np.cumsum(complete, axis=1) - 1)[codes, positions]
+        n_days = lengths.max() if len(rows) > 0 else 0
+        values = np.full((len(rows), n_days, len(self.variables)), np.nan, dtype=self.values.dtype)
+        values[codes, new_positions] = self.values[rows[codes], positions]
+        dates = np.full((len(rows), n_days), None, dtype=object)
+        dates[codes, new_positions] = self.dates[rows[codes], positions]
+        return Panel(values, ~np.isnan(values), lengths, self.participants[rows], dates, self.variables)
+
+def get_imputer(method, random_state=0):
+    if method == 'IterativeImputer':
+        return IterativeImputer(random_state=random_state)
+    elif method.find('KNNImputer:') >= 0:
+        method_array = method.split(':')
+        n_neighbors = int(method_array[1])
+        return KNNImputer(n_neighbors=n_neighbors, copy=False)
+    #sklearn KNNImputer default uses 5 neighbors
+    return KNNImputer(copy=False)
+
+def impute_participant(values, method_columns, random_state):
+    #Impute one participant block (rows x columns) with each (method, column positions) in turn
+    #Return the imputed block and the methods that could not be applied
+    values = values.copy()
+    failed_methods = []
+    for method, positions in method_columns:
+        imputer = get_imputer(method, random_state)
+        X_imputed = imputer.fit_transform(values[:, positions])
+        if X_imputed.shape[1] != len(positions):
+            failed_methods.append(method)
+            continue
+        values[:, positions] = X_imputed
+    return values, failed_methods
+
+#In-memory LRU of imputed participant blocks, bounded by the bytes of the blocks it holds
+imputation_cache = collections.OrderedDict()
+max_imputation_cache_size = 2**28
+
+def get_cached_imputation(key):
+    value = imputation_cache.get(key)
+    if value is not None:
+        imputation_cache.move_to_end(key)
+    return value
+
+def set_cached_imputation(key, value):
+    imputation_cache[key] = value
+    imputation_cache.move_to_end(key)
+    total = sum(block.nbytes for block, _ in imputation_cache.values())
+    while (total > max_imputation_cache_size) and (len(imputation_cache) > 0):
+        _, (block, _) = imputation_cache.popitem(last=False)
+        total -= block.nbytes
+
+def impute(df, methods, n_jobs=1, random_state=0, b_cache=True, b_disk_cache=False):
     #Impute missing data using method = IterativeImputer, KNNImputer:2 (using 2 neighbors)...
     #methods is a dictionary of key, value, where key contains the method 
     #and value contains all the columns where the method is applied.
-    df = df.replace({True: 1, False: 0})   
-    df_group = df.groupby(by='Subject ID')
-    participant_ids = list(set(df.index.get_level_values(0)))
-    frames = []
-    #Impute for each participant
-    for participant_id in participant_ids:
-        df_i = df_group.get_group(participant_id)        
-        df_i = df_i.reset_index()
-        df_i = df_i.set_index(['Date'])
-        for method, columns in methods.items():
-            if method == 'IterativeImputer':
-                imputer = IterativeImputer()
-            elif method.find('KNNImputer:') >= 0:
-                method_array = method.split(':')
-                n_neighbors = int(method_array[1])
-                imputer = KNNImputer(n_neighbors=n_neighbors, copy=False)
-            else:
-                #sklearn KNNImputer default uses 5 neighbors
-                imputer = KNNImputer(copy=False)                
-            X = df_i[columns].copy()
-            X = X.reset_index()
-            #sklearn imputer returns an array, so store and add back column names
-            all_column_names = X.columns
-            X_imputed = pd.DataFrame(imputer.fit_transform(X[columns]))           
-            if X_imputed.shape[1] != X[columns].shape[1]:
-                print('cannot impute participant %s' % participant_id)
-                continue           
-            X[columns] = X_imputed
-            X.columns = all_column_names
-            X = X.set_index(['Date'])           
-            df_i[columns] = X
-        df_i = df_i.reset_index().set_index(['Subject ID', 'Date'])        
-        frames.append(df_i)
-    df = pd.concat(frames)
-    df = df.dropna()
+    #Participants are imputed in n_jobs worker processes (seeded per participant), and results
+    #are cached in memory by a hash of each participant's block so only changed participants are
+    #re-imputed. Set b_disk_cache = True to also keep them on disk (see cache_utils).
+    df = df.replace({True: 1, False: 0})
     df = df.sort_index(level='Subject ID')
+    columns = []
+    for method_columns in methods.values():
+        columns += [x for x in method_columns if x not in columns]
+    method_columns = [(method, [columns.index(x) for x in method_columns]) for method, method_columns in methods.items()]
+    values = df[columns].to_numpy(dtype=float)
+    values_imputed = np.empty_like(values)
+    jobs = []
+    job_blocks = []
+    for participant_id, start, stop in get_participant_blocks(df):
+        seed = parallel_utils.get_seed(random_state, participant_id)
+        key = cache_utils.get_hash('impute', values[start:stop], method_columns, seed)
+        cached = get_cached_imputation(key) if b_cache else None
+        if b_cache and b_disk_cache and (cached is None):
+            cached = cache_utils.load(key)
+            if cached is not None:
+                set_cached_imputation(key, cached)
+        if cached is not None:
+            values_imputed[start:stop], failed_methods = cached
+            for method in failed_methods:
+                log('cannot impute participant %s' % participant_id)
+        else:
+            jobs.append((values[start:stop], method_columns, seed))
+            job_blocks.append((participant_id, start, stop, key))
+    results = parallel_utils.run_parallel(impute_participant, jobs, n_jobs)
+    for (participant_id, start, stop, key), (block, failed_methods) in zip(job_blocks, results):
+        for method in failed_methods:
+            log('cannot impute participant %s' % participant_id)
+        values_imputed[start:stop] = block
+        if b_cache:
+            set_cached_imputation(key, (block, failed_methods))
+            if b_disk_cache:
+                cache_utils.save(key, (block, failed_methods), b_evict=False)
+    if b_cache and b_disk_cache and len(jobs) > 0:
+        cache_utils.evict()
+    df[columns] = values_imputed
+    df = df.dropna()
     return df
         
-def get_pacf(df, names):   
-    df = df.dropna()
-    df = df.replace({True: 1, False: 0})
-    df_group = df.groupby(by='Subject ID')
-    participant_ids = list(set(df.index.get_level_values(0)))
-    
-    #Compute the pacf values for each participant, and aggregate the pacf values
+def stack_series(series_list):
+    #Stack series of different lengths into a zero-padded (series x time) array and a validity mask
+    n = np.array([len(x) for x in series_list], dtype=int)
+    mask = np.arange(n.max() if len(n) > 0 else 0) < n[:, None]
+    X = np.zeros(mask.shape)
+    if len(n) > 0:
+        X[mask] = np.concatenate([np.asarray(x, dtype=float) for x in series_list])
+    return X, mask, n
+
+def get_autocovariance_sums(X, mask, n, max_lags):
+    #Demean each series and compute sum_t x[t] x[t+k] for k = 0..max_lags for all series with one FFT
+    means = X.sum(axis=1) / np.maximum(n, 1)
+    X = np.where(mask, X - means[:, None], 0.)
+    n_fft = 1 << int(np.ceil(np.log2(max(2, 2 * X.shape[1]))))
+    F = np.fft.rfft(X, n=n_fft, axis=1)
+    return np.fft.irfft(F * np.conj(F), n=n_fft, axis=1)[:, :max_lags+1]
+
+def durbin_levinson(acov):
+    #Partial autocorrelations from autocovariances (series x lags) with the Durbin-Levinson recursion
+    n_series, n_lags = acov.shape
+    pacf_values = np.ones((n_series, n_lags))
+    phi = np.zeros((n_series, n_lags))
+    v = acov[:, 0].copy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for k in range(1, n_lags):
+            phi_kk = (acov[:, k] - (phi[:, 1:k] * acov[:, k-1:0:-1]).sum(axis=1)) / v
+            phi[:, 1:k] = phi[:, 1:k] - phi_kk[:, None] * phi[:, k-1:0:-1]
+            phi[:, k] = phi_kk
+            v = v * (1. - phi_kk**2)
+            pacf_values[:, k] = phi_kk
+    return pacf_values
+
+def get_acf_pacf_batch(series_list, max_lags, alpha=0.05, b_ljung_box=False):
+    #ACF (with Bartlett bands) and PACF (Yule-Walker adjusted, as statsmodels pacf) for all series at once
+    #Return a dictionary of (series x lags) arrays
+    X, mask, n = stack_series(series_list)
+    lags = np.arange(max_lags+1)
+    acov_sums = get_autocovariance_sums(X, mask, n, max_lags)
+    z = norm.ppf(1. - alpha / 2.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acf_values = acov_sums / acov_sums[:, :1]
+        var_acf = np.ones(acf_values.shape) / n[:, None]
+        var_acf[:, 0] = 0
+        var_acf[:, 2:] *= 1 + 2 * np.cumsum(acf_values[:, 1:-1]**2, axis=1)
+        pacf_values = durbin_levinson(acov_sums / (n[:, None] - lags))
+    var_pacf = np.ones(pacf_values.shape) / n[:, None]
+    var_pacf[:, 0] = 0
+    results = {'n':n, 'lags':lags,
+               'acf':acf_values, 'acf_lower':acf_values - z * np.sqrt(var_acf), 'acf_upper':acf_values + z * np.sqrt(var_acf),
+               'pacf':pacf_values, 'pacf_lower':pacf_values - z * np.sqrt(var_pacf), 'pacf_upper':pacf_values + z * np.sqrt(var_pacf)}
+    if b_ljung_box:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = acf_values[:, 1:]**2 / (n[:, None] - lags[1:])
+        lb_stat = np.zeros(acf_values.shape)
+        lb_stat[:, 1:] = (n * (n + 2))[:, None] * np.cumsum(terms, axis=1)
+        lb_pvalue = np.ones(acf_values.shape)
+        lb_pvalue[:, 1:] = chi2.sf(lb_stat[:, 1:], lags[1:])
+        results['lb_stat'] = lb_stat
+        results['lb_pvalue'] = lb_pvalue
+    return results
+
+def compute_acf_pacf(df, names, max_lags=15, alpha=0.05, b_ljung_box=False):
+    #Compute ACF and PACF for every eligible (participant, variable) series in one batch
+    #A series is eligible when it has more than 2*(max_lags+1) days and a mean >= 1
+    #Return a tidy frame indexed by (Subject ID, Variable, Lag); df can be a frame or a Panel
+    if isinstance(df, Panel):
+        panel = df.dropna()
+        blocks = [(participant_id, p, 0, n) for p, (participant_id, n) in enumerate(zip(panel.participants, panel.lengths))]
+    else:
+        df = df.dropna()
+        df = df.replace({True: 1, False: 0})
+        df = df.sort_index(level='Subject ID')
+        blocks = [(participant_id, 0, start, stop) for participant_id, start, stop in get_participant_blocks(df)]
+    keys = []
+    series_list = []
     for name in names:
-        pacf_averages = collections.defaultdict(list)
-        confidence_intervals = collections.defaultdict(list)
-        
-        for index, participant_id in enumerate(participant_ids):
-            df = df_group.get_group(participant_id)
-            current_threshold_lags = math.floor(df.shape[0]//2)-1
-            max_lags = 15
-            if (current_threshold_lags > max_lags) and (int(df[name].mean()) > 0):       
-                pacf_values, confidence_interval = pacf(df[name], nlags=max_lags, alpha=0.05)
-                lags = np.arange(max_lags+1)
-                #Plot for sanity test
-                #plot_pacf(df[name], lags=max_lags)
-                #plt.title(participant_id + ' ' + name + ' Partial Autocorrelation')
-                for i, lag in enumerate(lags):
-                    pacf_averages[lag].append(pacf_values[i])
-                    confidence_intervals[lag].append(confidence_interval[i])
-                    
-        lags = pacf_averages.keys()
-        pacf_values = np.array(list(pacf_averages.values()))
-        if len(pacf_values) > 0:
-            plt.figure()
-            pacf_values = pacf_values.mean(axis=1)
-            confidence_interval = np.array(list(confidence_intervals.values())).mean(axis=1)            
-            plt.fill_between(lags,
-                             confidence_interval[:, 0] - pacf_values,
-                             confidence_interval[:, 1] - pacf_values, alpha=0.25)
-            plt.scatter(lags, pacf_values, color='C0', zorder=2)
-            plt.bar(lags, pacf_values, width=0.1, color='black', zorder=1)
-            plt.axhline(y=0)
-            title = 'Average ' + name + ' Partial Autocorrelation'
-            plt.title(title)
+        values = panel.get(name) if isinstance(df, Panel) else df[name].to_numpy(dtype=float)[None, :]
+        for participant_id, p, start, stop in blocks:
+            current_threshold_lags = math.floor((stop - start)//2)-1
+            if (current_threshold_lags > max_lags) and (int(values[p, start:stop].mean()) > 0):
+                keys.append((participant_id, name))
+                series_list.append(values[p, start:stop])
+    columns = ['acf', 'acf_lower', 'acf_upper', 'pacf', 'pacf_lower', 'pacf_upper']
+    if b_ljung_box:
+        columns += ['lb_stat', 'lb_pvalue']
+    index_names = ['Subject ID', 'Variable', 'Lag']
+    if len(series_list) == 0:
+        return pd.DataFrame(columns=['n'] + columns, index=pd.MultiIndex.from_tuples([], names=index_names))
+    results = get_acf_pacf_batch(series_list, max_lags, alpha, b_ljung_box)
+    n_lags = max_lags + 1
+    index = pd.MultiIndex.from_arrays([np.repeat([k[0] for k in keys], n_lags),
+                                       np.repeat([k[1] for k in keys], n_lags),
+                                       np.tile(results['lags'], len(keys))], names=index_names)
+    data = {'n':np.repeat(results['n'], n_lags)}
+    for column in columns:
+        data[column] = results[column].reshape(-1)
+    return pd.DataFrame(data, index=index)
+
+def plot_average_pacf(df_pacf, name):
+    #Plot the PACF averaged over participants, with the average confidence band around 0
+    df_name = df_pacf.xs(name, level='Variable').groupby(level='Lag').mean()
+    lags = df_name.index.values
+    pacf_values = df_name['pacf'].values
+    plt.figure()
+    plt.fill_between(lags,
+                     df_name['pacf_lower'].values - pacf_values,
+                     df_name['pacf_upper'].values - pacf_values, alpha=0.25)
+    plt.scatter(lags, pacf_values, color='C0', zorder=2)
+    plt.bar(lags, pacf_values, width=0.1, color='black', zorder=1)
+    plt.axhline(y=0)
+    title = 'Average ' + name + ' Partial Autocorrelation'
+    plt.title(title)
+
+def get_pacf(df, names, max_lags=15, b_plot=True):
+    #Compute the pacf values for each participant, and plot the pacf values averaged over participants
+    df_pacf = compute_acf_pacf(df, names, max_lags=max_lags)
+    for name in names:
+        if name in set(df_pacf.index.get_level_values('Variable')):
+            if b_plot:
+                plot_average_pacf(df_pacf, name)
         else:
-            print('found no pacf values for', name)
+            log('found no pacf values for %s' % name)
+    return df_pacf
             
-def get_pearsonr(df, name, lagged_name, max_lag):
-    print('correlation between %s and lagged %s:' % (name, lagged_name))
-    df = df.dropna()
+def cross_correlate(a, b, n_lags, n_fft):
+    #c[k] = sum_t a[t] b[t-k] for k = 0..n_lags-1, computed with one FFT product
+    return np.fft.irfft(np.fft.rfft(a, n=n_fft) * np.conj(np.fft.rfft(b, n=n_fft)), n=n_fft)[:n_lags]
+
+def get_lagged_sums(x, y, n_lags):
+    #Sufficient statistics over all pairs (x[t], y[t-k]) where both values are observed, k = 0..n_lags-1
+    #Values are centered first for precision, and the means are returned to recover raw sums
+    mask_x = ~np.isnan(x)
+    mask_y = ~np.isnan(y)
+    mean_x = x[mask_x].mean() if mask_x.any() else 0.
+    mean_y = y[mask_y].mean() if mask_y.any() else 0.
+    xc = np.where(mask_x, x - mean_x, 0.)
+    yc = np.where(mask_y, y - mean_y, 0.)
+    mask_x = mask_x.astype(float)
+    mask_y = mask_y.astype(float)
+    n_fft = 1 << int(np.ceil(np.log2(max(2, 2 * len(x)))))
+    sums = {'n':np.rint(cross_correlate(mask_x, mask_y, n_lags, n_fft)),
+            'sx':cross_correlate(xc, mask_y, n_lags, n_fft),
+            'sy':cross_correlate(mask_x, yc, n_lags, n_fft),
+            'sxx':cross_correlate(xc**2, mask_y, n_lags, n_fft),
+            'syy':cross_correlate(mask_x, yc**2, n_lags, n_fft),
+            'sxy':cross_correlate(xc, yc, n_lags, n_fft)}
+    return sums, mean_x, mean_y
+
+def get_correlation_from_sums(n, sx, sy, sxx, syy, sxy):
+    #Pearson correlation and two-sided p-value (as scipy pearsonr) from sufficient statistics
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx**2) * (n * syy - sy**2))
+        corr = np.clip(corr, -1., 1.)
+        dof = n - 2
+        t_stat = corr * np.sqrt(dof / ((1. - corr) * (1. + corr)))
+        p_value = 2 * student_t.sf(np.abs(t_stat), dof)
+    p_value = np.where(np.abs(corr) == 1., 0., p_value)
+    p_value = np.where(dof > 0, p_value, np.nan)
+    return corr, p_value
+
+def compute_lagged_correlations(df, name, lagged_name, max_lag):
+    #Correlation between name[t] and lagged_name[t-lag] for lag = 1..max_lag-1, within each participant
+    #Rows are taken as consecutive days per participant, and missing values are masked (not dropped)
+    #Return the per participant correlations and the pooled correlations over all within-participant pairs
+    df = df[[name, lagged_name]].replace({True: 1, False: 0})
+    df = df.sort_index(level=[0, 1])
+    x_all = df[name].to_numpy(dtype=float)
+    y_all = df[lagged_name].to_numpy(dtype=float)
+    lags = np.arange(1, max_lag)
+    names = ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy']
+    pooled = {k: np.zeros(max_lag) for k in names}
+    frames = []
+    for participant_id, start, stop in get_participant_blocks(df):
+        sums, mean_x, mean_y = get_lagged_sums(x_all[start:stop], y_all[start:stop], max_lag)
+        corr, p_value = get_correlation_from_sums(*[sums[k] for k in names])
+        frames.append(pd.DataFrame({'Subject ID':participant_id, 'Lag':lags, 'n':sums['n'][1:].astype(int),
+                                    'corr':corr[1:], 'p_value':p_value[1:]}))
+        #Accumulate raw (uncentered) sums for the pooled correlation
+        n = sums['n']
+        pooled['n']   += n
+        pooled['sx']  += sums['sx'] + n * mean_x
+        pooled['sy']  += sums['sy'] + n * mean_y
+        pooled['sxx'] += sums['sxx'] + 2 * mean_x * sums['sx'] + n * mean_x**2
+        pooled['syy'] += sums['syy'] + 2 * mean_y * sums['sy'] + n * mean_y**2
+        pooled['sxy'] += sums['sxy'] + mean_y * sums['sx'] + mean_x * sums['sy'] + n * mean_x * mean_y
+    columns = ['Subject ID', 'Lag', 'n', 'corr', 'p_value']
+    df_participants = pd.concat(frames) if len(frames) > 0 else pd.DataFrame(columns=columns)
+    df_participants = df_participants.set_index(['Subject ID', 'Lag'])
+    corr, p_value = get_correlation_from_sums(*[pooled[k] for k in names])
+    df_pooled = pd.DataFrame({'n':pooled['n'][1:].astype(int), 'corr':corr[1:], 'p_value':p_value[1:]},
+                             index=pd.Index(lags, name='Lag'))
+    return {"participant_correlations":df_participants, "pooled_correlations":df_pooled}
+
+def get_pearsonr(df, name, lagged_name, max_lag, b_display=True):
+    results = compute_lagged_correlations(df, name, lagged_name, max_lag)
+    if b_display:
+        log('correlation between %s and lagged %s:' % (name, lagged_name))
+        for lag, row in results["pooled_correlations"].iterrows():
+            detail = ''
+            if row['p_value'] < 0.05:
+                detail = 'significant'
+            log('lag=%d   corr=%.5f   p_value=%s \t%s' % (lag, row['corr'], row['p_value'], detail))
+        log()
+    return results
+
+def get_autocovariances(X, max_lag):
+    #Sample autocovariances Gamma_h = sum_t x[t+h] x[t]' / T of a (T x k) series, h = 0..max_lag
+    T = X.shape[0]
+    X = X - X.mean(axis=0)
+    return np.stack([X[h:].T @ X[:T-h] / T for h in range(max_lag+1)])
+
+def solve_var_yule_walker(gammas, lag_order):
+    #Solve the Yule-Walker equations [Gamma_1 ... Gamma_p] = [A_1 ... A_p] R for a VAR(p)
+    #Return the coefficient matrices A_i (p x k x k) and the residual covariance
+    k = gammas.shape[1]
+    R = np.block([[gammas[j-i] if j >= i else gammas[i-j].T for j in range(lag_order)] for i in range(lag_order)])
+    G = np.hstack([gammas[i] for i in range(1, lag_order+1)])
+    A = np.linalg.solve(R.T, G.T).T
+    A = np.stack([A[:, i*k:(i+1)*k] for i in range(lag_order)])
+    sigma = gammas[0] - sum(A[i] @ gammas[i+1].T for i in range(lag_order))
+    return A, sigma
+
+def get_var_information_criteria(sigma, nobs, k, lag_order):
+    #Information criteria as in statsmodels VARResults (model with a constant)
+    free_params = lag_order * k**2 + k
+    df_model = lag_order * k + 1
+    log_det = np.linalg.slogdet(sigma)[1]
+    return {'aic':log_det + (2. / nobs) * free_params,
+            'bic':log_det + (np.log(nobs) / nobs) * free_params,
+            'hqic':log_det + (2. * np.log(np.log(nobs)) / nobs) * free_params,
+            'fpe':((nobs + df_model) / (nobs - df_model)) ** k * np.exp(log_det)}
+
+def select_var_order(gammas_list, nobs_list, max_lag, criterion='aic'):
+    #Select one lag order for the cohort from the autocovariances of all participants,
+    #pooled with weights = number of observations
+    if len(gammas_list) == 0:
+        raise ValueError('select_var_order needs the autocovariances of at least one participant')
+    nobs_list = np.asarray(nobs_list, dtype=float)
+    gammas = np.tensordot(nobs_list, np.stack(gammas_list), axes=1) / nobs_list.sum()
+    k = gammas.shape[1]
+    scores = {}
+    for lag_order in range(1, max_lag+1):
+        nobs = (nobs_list - lag_order).sum()
+        try:
+            _, sigma = solve_var_yule_walker(gammas, lag_order)
+        except np.linalg.LinAlgError:
+            continue
+        scores[lag_order] = get_var_information_criteria(sigma, nobs, k, lag_order)[criterion]
+    if len(scores) == 0:
+        raise ValueError('cannot select a VAR lag order: the pooled autocovariances are singular '
+                         '(a variable is constant for every participant)')
+    return min(scores, key=scores.get)
+
+def fit_var_participant(values, names, lag_order, method):
+    #Fit a VAR(lag_order) with a constant to one participant (T x k values)
+    #method = 'ols' uses statsmodels, method = 'yw' solves the Yule-Walker equations (fast path for long series)
+    #Return None if the series is too short or cannot be fitted (for example a constant variable)
+    T, k = values.shape
+    nobs = T - lag_order
+    if nobs - (lag_order * k + 1) <= 0:
+        return None
+    try:
+        if method == 'yw':
+            mean = values.mean(axis=0)
+            A, sigma = solve_var_yule_walker(get_autocovariances(values, lag_order), lag_order)
+            intercept = (np.eye(k) - A.sum(axis=0)) @ mean
+            params = np.vstack([intercept[None, :]] + [A[i].T for i in range(lag_order)])
+            row = get_var_information_criteria(sigma, nobs, k, lag_order)
+        else:
+            results = VAR(values).fit(lag_order, trend='c')
+            params = np.asarray(results.params)
+            row = {'aic':results.aic, 'bic':results.bic, 'hqic':results.hqic, 'fpe':results.fpe}
+    except (np.linalg.LinAlgError, ValueError):
+        return None
+    row['nobs'] = nobs
+    row['lag_order'] = lag_order
+    terms = ['const'] + ['L%d.%s' % (i, name) for i in range(1, lag_order+1) for name in names]
+    for j, equation in enumerate(names):
+        for i, term in enumerate(terms):
+            row[equation + ' ~ ' + term] = params[i, j]
+    return row
+
+def compute_panel_VAR(df, names, max_lag, lag_order=None, criterion='aic', method='ols', n_jobs=1):
+    #Fit a VAR for each participant in n_jobs worker processes
+    #If lag_order is None, one lag order is selected for the cohort from the autocovariances
+    #of all participants (computed once) using criterion = 'aic', 'bic', 'hqic' or 'fpe'
+    #Return one row per participant with the coefficients and information criteria
+    df = df[names].dropna()
     df = df.replace({True: 1, False: 0})
-    for lag in range(1,max_lag):
-        series1 = df[name].iloc[lag:]
-        series2 = df[lagged_name].iloc[:-lag]
-        results = pearsonr(series1, series2)
-        corr = results[0]
-        p_value = results[1]
-        detail = ''
-        if p_value < 0.05:
-            detail = 'significant'
-        print('lag=%d   corr=%.5f   p_value=%s \t%s' % (lag, corr, p_value, detail))
-    print()
-
-def compute_VAR(df, names, max_lag):
+    df = df.sort_index(level=[0, 1])
+    values = df.to_numpy(dtype=float)
+    blocks = [b for b in get_participant_blocks(df) if (b[2] - b[1]) > max_lag + 1]
+    if len(blocks) == 0:
+        log('no participant has more than %d days' % (max_lag + 1))
+        return pd.DataFrame(index=pd.Index([], name='Subject ID'))
+    if lag_order is None:
+        gammas_list = [get_autocovariances(values[start:stop], max_lag) for _, start, stop in blocks]
+        nobs_list = [stop - start for _, start, stop in blocks]
+        lag_order = select_var_order(gammas_list, nobs_list, max_lag, criterion)
+    jobs = [(values[start:stop], names, lag_order, method) for _, start, stop in blocks]
+    rows = parallel_utils.run_parallel(fit_var_participant, jobs, n_jobs)
+    participant_ids = [b[0] for b, row in zip(blocks, rows) if row is not None]
+    df_var = pd.DataFrame([row for row in rows if row is not None], index=pd.Index(participant_ids, name='Subject ID'))
+    return df_var
+
+def compute_VAR(df, names, max_lag, b_panel=False, lag_order=None, criterion='aic', method='ols', n_jobs=1,
+                b_cache=False):
+    #Set b_panel = True to fit one VAR per participant (see compute_panel_VAR) instead of the pooled VAR
+    #Set b_cache = True to reuse fits stored on disk (see cache_utils); the pooled VAR is then
+    #returned as a CachedFit
+    if b_panel:
+        key = cache_utils.get_hash('compute_panel_VAR', df[names], max_lag, lag_order, criterion, method) if b_cache else None
+        return cache_utils.cached_call(key, lambda: compute_panel_VAR(df, names, max_lag, lag_order, criterion,
+                                                                      method, n_jobs), b_cache)
     df = df.dropna()
     df = df.reset_index()
     df = df.replace({True: 1, False: 0})
     df = df[names]
-    model = VAR(df)
-    results = model.fit(maxlags=max_lag)
-    print(results.summary())
-
-def get_correlations(df):
-    df = df.replace({True: 1, False: 0})    
-    df_correlations = df.corr()
-    figsize = (7,8)
-    if df.shape[1] > 12:
-        figsize = (9,10)
+    def fit_var():
+        model = VAR(df)
+        results = model.fit(maxlags=max_lag)
+        return CachedFit(results) if b_cache else results
+
+    key = cache_utils.get_hash('compute_VAR', df, max_lag) if b_cache else None
+    results = cache_utils.cached_call(key, fit_var, b_cache)
+    log(results.summary())
+    return results
+
+def plot_correlation_heatmap(df_correlations, figsize=None, cbar_kws=None):
+    if figsize == None:
+        figsize = (7,8)
+        if df_correlations.shape[1] > 12:
+            figsize = (9,10)
     plt.figure(figsize=figsize)
-    sn.heatmap(df_correlations, cmap=cm.seismic, annot=True, vmin=-1, vmax=1,
-               cbar_kws={"orientation": "horizontal"})
+    sn.heatmap(df_correlations, cmap=cm.seismic, annot=True, vmin=-1, vmax=1, cbar_kws=cbar_kws)
     plt.show()
+
+def get_correlations(df, accumulator=None, b_plot=True):
+    #Pooled correlations of the columns of df (a frame or a Panel), or of the rows added to a
+    #CorrelationAccumulator
+    if accumulator is not None:
+        df_correlations = accumulator.get_pooled_correlations()
+    elif isinstance(df, Panel):
+        correlations = get_pooled_correlations_from_moments(*get_block_moments(df.get(df.variables)))
+        df_correlations = pd.DataFrame(correlations, index=df.variables, columns=df.variables)
+    else:
+        df = df.replace({True: 1, False: 0})    
+        df_correlations = df.corr()
+    if b_plot:
+        plot_correlation_heatmap(df_correlations, cbar_kws={"orientation": "horizontal"})
     return df_correlations
 
-def get_correlations_average_within_participant(df, behaviors, activities, rename_dict=None, b_plot=False):
-    df = df.replace({True: 1, False: 0})
-    participants = list(set([p for (p, date) in df.index.values]))
-    if rename_dict != None:
-        df=df.rename(columns=rename_dict)
-    columns = list(df.columns)
+def stack_blocks(values, blocks):
+    #Stack the (participant, start, stop) row blocks of a (rows x variables) array
+    #into a (participants x max rows x variables) array padded with NaN
+    lengths = np.array([stop - start for _, start, stop in blocks], dtype=int)
+    starts = np.array([start for _, start, _ in blocks], dtype=int)
+    X = np.full((len(blocks), lengths.max() if len(blocks) > 0 else 0, values.shape[1]), np.nan)
+    if len(blocks) > 0:
+        rows = np.concatenate([np.arange(start, stop) for _, start, stop in blocks])
+        codes = np.repeat(np.arange(len(blocks)), lengths)
+        positions = rows - np.repeat(starts, lengths)
+        X[codes, positions] = values[rows]
+    return X
+
+def get_grouped_correlation_sums(X):
+    #Pairwise-complete sufficient statistics for (participants x rows x variables) arrays with NaN
+    #n[p,i,j] = number of rows where both i and j are observed, sx[p,i,j] = sum of (centered) x_i
+    #over those rows, sxx[p,i,j] = sum of x_i^2 and sxy[p,i,j] = sum of x_i x_j
+    M = (~np.isnan(X)).astype(float)
+    counts = M.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, np.nansum(X, axis=1) / counts, 0.)
+    Xc = np.where(M > 0, X - means[:, None, :], 0.)
+    Mt = M.transpose(0, 2, 1)
+    Xct = Xc.transpose(0, 2, 1)
+    return {'n':Mt @ M, 'sx':Xct @ M, 'sxx':(Xct**2) @ M, 'sxy':Xct @ Xc}
+
+def compute_correlation_matrices(df, columns):
+    #Pairwise-complete Pearson correlation matrices of columns for all participants in one batched pass
+    #Return the participants, the (participant x var x var) correlations, p-values and pair counts
+    #df can be a frame or a Panel
+    if isinstance(df, Panel):
+        participants = list(df.participants)
+        X = df.get(list(columns))
+    else:
+        df = df[columns].replace({True: 1, False: 0})
+        df = df.sort_index(level='Subject ID')
+        blocks = get_participant_blocks(df)
+        participants = [b[0] for b in blocks]
+        X = stack_blocks(df.to_numpy(dtype=float), blocks)
+    sums = get_grouped_correlation_sums(X)
+    sy = sums['sx'].transpose(0, 2, 1)
+    syy = sums['sxx'].transpose(0, 2, 1)
+    correlations, p_values = get_correlation_from_sums(sums['n'], sums['sx'], sy, sums['sxx'], syy, sums['sxy'])
+    return {"participants":participants, "columns":list(columns), "correlations":correlations,
+            "p_values":p_values, "counts":sums['n'].astype(int)}
+
+def get_block_moments(X):
+    #Pairwise-complete moments of a (participants x rows x variables) array with NaN
+    #n[p,i,j] = rows where i and j are both observed, mean[p,i,j] = mean of x_i over those rows,
+    #m2[p,i,j] = sum of squared deviations of x_i and comoment[p,i,j] = sum of cross deviations
+    sums = get_grouped_correlation_sums(X)
+    M = ~np.isnan(X)
+    counts = M.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, np.nansum(X, axis=1) / counts, 0.)
+        shift = np.where(sums['n'] > 0, sums['sx'] / sums['n'], 0.)
+    mean = means[:, :, None] + shift
+    m2 = sums['sxx'] - sums['sx'] * shift
+    comoment = sums['sxy'] - sums['sx'] * shift.transpose(0, 2, 1)
+    return sums['n'], mean, m2, comoment
+
+def merge_moments(moments_a, moments_b):
+    #Combine two sets of pairwise moments (Chan et al. parallel update of the Welford moments)
+    n_a, mean_a, m2_a, comoment_a = moments_a
+    n_b, mean_b, m2_b, comoment_b = moments_b
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(n > 0, n_b / n, 0.)
+    delta = mean_b - mean_a
+    mean = mean_a + delta * weight
+    m2 = m2_a + m2_b + delta**2 * n_a * weight
+    comoment = comoment_a + comoment_b + delta * np.swapaxes(delta, -1, -2) * n_a * weight
+    return n, mean, m2, comoment
+
+def get_pooled_correlations_from_moments(n, mean, m2, comoment):
+    #Correlations over the rows of all participants (as DataFrame.corr) from per-participant moments
+    total = n.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pooled_mean = np.where(total > 0, (n * mean).sum(axis=0) / total, 0.)
+        delta = np.where(n > 0, mean - pooled_mean, 0.)
+        pooled_m2 = (m2 + n * delta**2).sum(axis=0)
+        pooled_comoment = (comoment + n * delta * delta.transpose(0, 2, 1)).sum(axis=0)
+        correlations = pooled_comoment / np.sqrt(pooled_m2 * pooled_m2.T)
+    return np.where(total > 1, np.clip(correlations, -1., 1.), np.nan)
+
+class CorrelationAccumulator:
+    #Streaming per-participant counts, means and co-moments of columns (pairwise complete)
+    #New days are added with append/update, shards are combined with merge, and the state
+    #can be saved and loaded between runs
+    def __init__(self, columns):
+        self.columns = list(columns)
+        n_columns = len(self.columns)
+        self.participants = []
+        self.positions = {}
+        self.n = np.zeros((0, n_columns, n_columns))
+        self.mean = np.zeros((0, n_columns, n_columns))
+        self.m2 = np.zeros((0, n_columns, n_columns))
+        self.comoment = np.zeros((0, n_columns, n_columns))
+        self.n_rows = np.zeros(0, dtype=int)
+        self.last_dates = np.array([], dtype='datetime64[ns]')
+
+    def __len__(self):
+        return len(self.participants)
+
+    def get_positions(self, participant_ids):
+        #Positions of participant_ids in the state arrays, adding the new participants
+        new_ids = [pid for pid in dict.fromkeys(participant_ids) if pid not in self.positions]
+        if len(new_ids) > 0:
+            for pid in new_ids:
+                self.positions[pid] = len(self.participants)
+                self.participants.append(pid)
+            shape = (len(new_ids),) + self.n.shape[1:]
+            self.n = np.concatenate([self.n, np.zeros(shape)])
+            self.mean = np.concatenate([self.mean, np.zeros(shape)])
+            self.m2 = np.concatenate([self.m2, np.zeros(shape)])
+            self.comoment = np.concatenate([self.comoment, np.zeros(shape)])
+            self.n_rows = np.concatenate([self.n_rows, np.zeros(len(new_ids), dtype=int)])
+            self.last_dates = np.concatenate([self.last_dates, np.full(len(new_ids), np.datetime64('NaT'), dtype='datetime64[ns]')])
+        return np.array([self.positions[pid] for pid in participant_ids], dtype=int)
+
+    def add_moments(self, positions, moments, n_rows, last_dates):
+        state = (self.n[positions], self.mean[positions], self.m2[positions], self.comoment[positions])
+        self.n[positions], self.mean[positions], self.m2[positions], self.comoment[positions] = merge_moments(state, moments)
+        self.n_rows[positions] += n_rows
+        self.last_dates[positions] = np.fmax(self.last_dates[positions], last_dates)
+
+    def append(self, df):
+        #Add the rows of df (Subject ID, Date indexed); the rows must not have been added before
+        df = df[self.columns].replace({True: 1, False: 0})
+        df = df.sort_index(level=[0, 1])
+        blocks = get_participant_blocks(df)
+        if len(blocks) == 0:
+            return self
+        moments = get_block_moments(stack_blocks(df.to_numpy(dtype=float), blocks))
+        dates = pd.to_datetime(df.index.get_level_values(1)).to_numpy(dtype='datetime64[ns]')
+        n_rows = np.array([stop - start for _, start, stop in blocks], dtype=int)
+        last_dates = np.array([dates[start:stop].max() for _, start, stop in blocks], dtype='datetime64[ns]')
+        self.add_moments(self.get_positions([b[0] for b in blocks]), moments, n_rows, last_dates)
+        return self
+
+    def update(self, df):
+        #Add only the rows of df dated after the last day already added for their participant
+        participant_ids = df.index.get_level_values(0)
+        dates = pd.to_datetime(df.index.get_level_values(1)).to_numpy(dtype='datetime64[ns]')
+        last_dates = np.array([self.last_dates[self.positions[pid]] if pid in self.positions else np.datetime64('NaT')
+                               for pid in participant_ids], dtype='datetime64[ns]')
+        b_new = np.isnat(last_dates) | (dates > last_dates)
+        return self.append(df[b_new])
+
+    def merge(self, other):
+        #Combine with an accumulator built on another shard of rows
+        if other.columns != self.columns:
+            raise ValueError('cannot merge accumulators with different columns')
+        if len(other) > 0:
+            self.add_moments(self.get_positions(other.participants), (other.n, other.mean, other.m2, other.comoment),
+                             other.n_rows, other.last_dates)
+        return self
+
+    def save(self, path):
+        #Participant ids keep their dtype (integer ids come back as integers from load)
+        participants = np.array(self.participants)
+        if participants.dtype == object:
+            participants = participants.astype(str)
+        np.savez(path, columns=np.array(self.columns, dtype=str), participants=participants,
+                 n=self.n, mean=self.mean, m2=self.m2, comoment=self.comoment, n_rows=self.n_rows,
+                 last_dates=self.last_dates)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            accumulator = cls(data['columns'].tolist())
+            accumulator.get_positions(data['participants'].tolist())
+            accumulator.n, accumulator.mean = data['n'], data['mean']
+            accumulator.m2, accumulator.comoment = data['m2'], data['comoment']
+            accumulator.n_rows, accumulator.last_dates = data['n_rows'], data['last_dates']
+        return accumulator
+
+    def get_indices(self, columns):
+        columns = self.columns if columns is None else list(columns)
+        return columns, np.array([self.columns.index(c) for c in columns], dtype=int)
+
+    def get_counts(self, columns=None):
+        #Number of observed days per participant and column
+        columns, indices = self.get_indices(columns)
+        counts = self.n[:, indices, indices].astype(int)
+        return pd.DataFrame(counts, index=pd.Index(self.participants, name='Subject ID'), columns=columns)
+
+    def get_means(self, columns=None):
+        #Mean per participant and column (NaN without observed days)
+        columns, indices = self.get_indices(columns)
+        means = np.where(self.n[:, indices, indices] > 0, self.mean[:, indices, indices], np.nan)
+        return pd.DataFrame(means, index=pd.Index(self.participants, name='Subject ID'), columns=columns)
+
+    def get_yields(self, td, columns=None):
+        #Number of participants with at least td observed days, and their total days, per column
+        df_counts = self.get_counts(columns)
+        valid = df_counts >= td
+        return pd.DataFrame({'participants':valid.sum(), 'days':df_counts.where(valid, 0).sum()})
+
+    def get_correlations(self, columns=None):
+        #Within-participant correlation matrices, in the format of compute_correlation_matrices
+        columns, indices = self.get_indices(columns)
+        grid = np.ix_(np.arange(len(self.participants)), indices, indices)
+        n, m2, comoment = self.n[grid], self.m2[grid], self.comoment[grid]
+        correlations, p_values = get_correlation_from_sums(n, 0., 0., m2, m2.transpose(0, 2, 1), comoment)
+        return {"participants":list(self.participants), "columns":columns, "correlations":correlations,
+                "p_values":p_values, "counts":n.astype(int)}
+
+    def get_pooled_correlations(self, columns=None):
+        #Correlations over the rows of all participants (as DataFrame.corr on the accumulated rows)
+        columns, indices = self.get_indices(columns)
+        grid = np.ix_(np.arange(len(self.participants)), indices, indices)
+        correlations = get_pooled_correlations_from_moments(self.n[grid], self.mean[grid], self.m2[grid],
+                                                            self.comoment[grid])
+        return pd.DataFrame(correlations, index=columns, columns=columns)
+
+def get_correlations_average_within_participant(df, behaviors, activities, rename_dict=None, b_plot=False,
+                                                accumulator=None):
+    #Average within-participant correlations; df can be a frame or a Panel, and with an accumulator
+    #the correlations come from its accumulated moments (df may then be None and rename_dict is not applied)
+    if accumulator is not None:
+        columns = accumulator.columns
+    elif isinstance(df, Panel):
+        if rename_dict != None:
+            df = df.rename(rename_dict)
+        columns = df.variables
+    else:
+        if rename_dict != None:
+            df=df.rename(columns=rename_dict)
+        columns = list(df.columns)
     valid_columns = []
     for col in columns:
         if (col in activities) or (col in behaviors):
             valid_columns.append(col)     
-    df = df[valid_columns]   
+    if accumulator is not None:
+        results = accumulator.get_correlations(valid_columns)
+    else:
+        results = compute_correlation_matrices(df, valid_columns)
     df_correlation_averages=pd.DataFrame(np.zeros((len(valid_columns),len(activities))), index=valid_columns, columns=activities)
-    correlations_dict = {}
-    group = df.groupby(by='Subject ID')
-    for participant in participants:
-        df_individual = group.get_group(participant)
-        df_correlations = df_individual.corr(method='pearson')
-        correlations_dict[participant] = df_correlations        
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        averages = np.nanmean(results["correlations"], axis=0)
     for activity in activities:
-        activity_averages = []
-        for k, df_corr in correlations_dict.items():
-            activity_averages.append(df_corr[activity])
-        activity_averages = np.array(activity_averages)
-        averages = np.nanmean(np.array(activity_averages), axis=0)
-        df_correlation_averages[activity] = np.nanmean(np.array(activity_averages), axis=0)
+        df_correlation_averages[activity] = averages[:, valid_columns.index(activity)]
     if b_plot:
-        plt.figure(figsize=(2,9))
-        sn.heatmap(df_correlation_averages, cmap=cm.seismic, annot=True, vmin=-1, vmax=1)
-        plt.show()
+        plot_correlation_heatmap(df_correlation_averages, figsize=(2,9))
     return df_correlation_averages
 
+def get_permutation_indices(n_rows, n_permutations, block_size, rng):
+    #(n_permutations x n_rows) row indices permuting consecutive blocks of block_size rows
+    #(block_size = 1 is a plain permutation; the last block may be shorter)
+    n_blocks = -(-n_rows // block_size)
+    order = np.argsort(rng.random((n_permutations, n_blocks)), axis=1)
+    rows = np.arange(n_blocks * block_size).reshape(n_blocks, block_size)[order].reshape(n_permutations, -1)
+    return rows[rows < n_rows].reshape(n_permutations, n_rows)
+
+def get_cross_correlations(X, MX, Y, MY):
+    #Pairwise-complete correlations and p-values between the columns of (batch x rows x n_x) X
+    #and (rows x n_y) Y, with missing values set to 0 and observed masks MX and MY
+    Xt, MXt = X.transpose(0, 2, 1), MX.transpose(0, 2, 1)
+    return get_correlation_from_sums(MXt @ MY, Xt @ MY, MXt @ Y, (Xt**2) @ MY, MXt @ Y**2, Xt @ Y)
+
+def permutation_test_participant(values, n_x, n_permutations, block_size, seed, batch_size=1000, b_null=True):
+    #Permutation test of the correlations between the first n_x columns of values and the others
+    #The rows of the first columns are (block) permuted against the fixed rows of the others
+    #Null draws with an undefined correlation (too few pairwise-complete days) are left out of the p-values
+    #Return the observed correlations, the two-sided permutation p-values and the null distribution
+    #(None if b_null = False)
+    with np.errstate(invalid='ignore'):
+        values = values - np.nanmean(values, axis=0)
+    M = ~np.isnan(values)
+    values = np.where(M, values, 0.)
+    X, MX = values[:, :n_x], M[:, :n_x].astype(float)
+    Y, MY = values[:, n_x:], M[:, n_x:].astype(float)
+    correlations, _ = get_cross_correlations(X[None], MX[None], Y, MY)
+    correlations = correlations[0]
+    rng = np.random.default_rng(seed)
+    null = np.empty((n_permutations, n_x, Y.shape[1]))
+    for start in range(0, n_permutations, batch_size):
+        stop = min(start + batch_size, n_permutations)
+        indices = get_permutation_indices(len(values), stop - start, block_size, rng)
+        null[start:stop], _ = get_cross_correlations(X[indices], MX[indices], Y, MY)
+    finite = np.isfinite(null)
+    exceed = (finite & (np.abs(null) >= np.abs(correlations) - 1e-12)).sum(axis=0)
+    p_values = np.where(np.isnan(correlations), np.nan, (1. + exceed) / (1. + finite.sum(axis=0)))
+    return correlations, p_values, (null if b_null else None)
+
+def compute_permutation_correlations(df, behaviors, activities, n_permutations=1000, block_size=1,
+                                     n_jobs=1, random_state=0, b_null=True):
+    #Within-participant correlations between behaviors and activities with permutation p-values
+    #Rows are taken as consecutive days per participant; block_size > 1 permutes blocks of days to
+    #keep the short-range autocorrelation of the behaviors under the null
+    #Each participant gets its own seed (from random_state), so results do not depend on n_jobs
+    #b_null = True also returns the null distributions, a float64 array of
+    #participants x n_permutations x behaviors x activities (8 bytes each)
+    columns = list(behaviors) + list(activities)
+    df = df[columns].replace({True: 1, False: 0})
+    df = df.sort_index(level=[0, 1])
+    values = df.to_numpy(dtype=float)
+    blocks = get_participant_blocks(df)
+    jobs = [(values[start:stop], len(behaviors), n_permutations, block_size,
+             parallel_utils.get_seed(random_state, participant_id), 1000, b_null) for participant_id, start, stop in blocks]
+    results = parallel_utils.run_parallel(permutation_test_participant, jobs, n_jobs)
+    output = {"participants":[b[0] for b in blocks], "behaviors":list(behaviors), "activities":list(activities),
+              "correlations":np.array([r[0] for r in results]), "p_values":np.array([r[1] for r in results])}
+    if b_null:
+        output["null_distributions"] = np.array([r[2] for r in results])
+    return output
+
 def get_data_yields(df, td, th, behaviors, yields):
-    columns = list(df.columns)
+    columns = df.variables if isinstance(df, Panel) else list(df.columns)
     valid_columns = []
     for col in columns:
         if (col in yields) or (col in behaviors):
             valid_columns.append(col)    
     df_yield_list=pd.DataFrame(np.zeros((len(valid_columns),len(yields))), index=valid_columns, columns=yields)
+    behaviors = [behavior for behavior in behaviors if behavior in columns]
+    available_data = get_available_data_per_behavior([td], [th], df, behaviors)
     for behavior in behaviors:
-        if behavior in df:
-            df_behavior = df[['Fitbit Step Count', 'Fitbit Minutes Worn', behavior]]            
-            table_days, table_participants, _ = get_available_data([td], [th], df_behavior)
-            df_yield_list.loc[behavior,yields[0]] = table_participants.values[0][0]
-            df_yield_list.loc[behavior,yields[1]] = table_days.values[0][0]
+        df_yield_list.loc[behavior,yields[0]] = available_data[behavior]["dfparticipants"].values[0][0]
+        df_yield_list.loc[behavior,yields[1]] = available_data[behavior]["dfdays"].values[0][0]
     return df_yield_list.astype(int)
 
 def update_name(old_name):
     return str(old_name).replace(' ', '_').lower()
     
-def perform_gee(df, y_name, x_array, groups_name, fixed_effect='',
-                family='Gaussian', cov_struct='Exchangeable', x_lim=None):
-    #Perform GEE Linear Regression (additional options are fixed_effect, family and cov_struct)
-    df = df.dropna()
-    df = df.replace({True: 1, False: 0})
-    df = df.reset_index()
-
+def get_family(family):
     if family == 'Gaussian':
-        fam = sm.families.Gaussian()
+        return family, sm.families.Gaussian()
     elif family == 'Poisson':
-        fam = sm.families.Poisson()
+        return family, sm.families.Poisson()
     elif family == 'Binomial':
-        fam = sm.families.Binomial()
-    else:
-        print('undefined family = %s, family is set to Gaussian' % family)
-        family = 'Gaussian'
-        fam = sm.families.Gaussian()
+        return family, sm.families.Binomial()
+    log('undefined family = %s, family is set to Gaussian' % family)
+    return 'Gaussian', sm.families.Gaussian()
 
+def get_cov_struct(cov_struct):
     if cov_struct == 'Independence':
-        cov = sm.cov_struct.Independence() 
+        return cov_struct, sm.cov_struct.Independence()
     elif cov_struct == 'Exchangeable':
-        cov = sm.cov_struct.Exchangeable()
-    else:
-        print('undefined cov_struct = %s, cov_struct is set to Exchangeable' % cov_struct)
-        cov_struct = 'Exchangeable'
-        cov = sm.cov_struct.Exchangeable()
+        return cov_struct, sm.cov_struct.Exchangeable()
+    log('undefined cov_struct = %s, cov_struct is set to Exchangeable' % cov_struct)
+    return 'Exchangeable', sm.cov_struct.Exchangeable()
+
+def get_equation(y_name, x_array, fixed_effect=''):
+    #Formula y_name ~ x1 + x2 ... (+ C(fixed_effect)) using the update_name column names
+    equation = update_name(y_name) + " ~ " + ' + '.join([update_name(x) for x in x_array])
+    if fixed_effect != '':
+        equation += " + C(" + update_name(fixed_effect) + ")"
+    return equation
+
+def plot_coefficients(df_coef, title, figsize=(10,3), x_lim=None):
+    #Horizontal bar chart of the coefficients in df_coef['coef']
+    ax = df_coef[['coef']].plot.barh(figsize=figsize)
+    ax.axvline(0, color='black', lw=1)
+    if x_lim != None:
+        ax.set_xlim(x_lim)
+    plt.grid(True)
+    plt.title(title)
+
+def within_transform(values, codes):
+    #Subtract the group mean of each column (within transformation that absorbs group fixed effects)
+    #Return the demeaned (rows x columns) values and the (groups x columns) means
+    counts = np.bincount(codes)
+    means = np.stack([np.bincount(codes, weights=values[:, j], minlength=len(counts))
+                      for j in range(values.shape[1])], axis=1) / counts[:, None]
+    return values - means[codes], means
+
+def get_fixed_effect_intercepts(df, y_name, x_array, fixed_effect, params):
+    #Recover the per group intercepts of a within (demeaned) fit: mean(y) - mean(x) @ params
+    df = df.dropna()
+    df = df.replace({True: 1, False: 0})
+    df = df.reset_index()
+    df.columns = [update_name(x) for x in df.columns]
+    fixed_effect = update_name(fixed_effect)
+    x_names = [update_name(x) for x in x_array]
+    df_means = df.groupby(fixed_effect)[[update_name(y_name)] + x_names].mean()
+    intercepts = df_means[update_name(y_name)] - df_means[x_names].values @ np.asarray(params)[:len(x_names)]
+    return intercepts.rename('intercept')
+
+def check_within(b_within, fixed_effect, family='Gaussian'):
+    #The within transformation is only valid for linear (Gaussian) models with a fixed effect
+    if b_within and (fixed_effect != '') and (family != 'Gaussian'):
+        log('within fixed effects need family = Gaussian, using C(%s) dummies' % fixed_effect)
+        return False
+    return b_within and (fixed_effect != '')
+
+class CachedFit:
+    #Fitted parameters and summary of a statsmodels fit, as stored in the disk cache
+    #(formula results cannot be restored reliably from a pickle, so only these are kept)
+    attributes = ['params', 'bse', 'stderr', 'tvalues', 'pvalues', 'scale', 'nobs', 'df_resid', 'df_model',
+                  'aic', 'bic', 'hqic', 'fpe', 'llf', 'k_ar', 'sigma_u']
+
+    def __init__(self, results):
+        for name in self.attributes:
+            #Results classes without the attribute (or that do not implement it) are skipped
+            try:
+                setattr(self, name, getattr(results, name))
+            except (AttributeError, NotImplementedError):
+                pass
+        try:
+            self.conf_int_values = results.conf_int()
+        except (AttributeError, NotImplementedError):
+            self.conf_int_values = None
+        self.summary_text = str(results.summary())
+
+    def summary(self):
+        return self.summary_text
+
+    def conf_int(self):
+        return self.conf_int_values
+
+def perform_gee(df, y_name, x_array, groups_name, fixed_effect='',
+                family='Gaussian', cov_struct='Exchangeable', x_lim=None, b_within=False, b_cache=False, b_plot=True):
+    #Perform GEE Linear Regression (additional options are fixed_effect, family and cov_struct)
+    #Set b_within = True to absorb the fixed_effect by demeaning within groups instead of adding
+    #C(fixed_effect) dummies (the intercepts can be recovered with get_fixed_effect_intercepts)
+    #Set b_cache = True to reuse fits stored on disk (see cache_utils); results is then a CachedFit
+    df = df.dropna()
+    df = df.replace({True: 1, False: 0})
+    df = df.reset_index()
+
+    family, fam = get_family(family)
+    cov_struct, cov = get_cov_struct(cov_struct)
+    b_within = check_within(b_within, fixed_effect, family)
 
     df.columns = [update_name(x) for x in df.columns]
+    equation = get_equation(y_name, x_array, fixed_effect)
     y_name = update_name(y_name)
     groups = update_name(groups_name)
 
-    equation = y_name + " ~ "
-    for index, covariate in enumerate(x_array):
-        covariate = update_name(covariate)
-        if index == 0:
-            equation += covariate
-        else:
-            equation += ' + ' + covariate
-
     figsize = (10,3)
-    if fixed_effect != '':
-        fixed_effect = update_name(fixed_effect)
-        equation += " + C(" + fixed_effect + ")"
+    ddof_scale = None
+    n_absorbed = 0
+    if b_within:
+        columns = [y_name] + [update_name(x) for x in x_array]
+        codes = pd.factorize(df[update_name(fixed_effect)])[0]
+        df[columns] = within_transform(df[columns].to_numpy(dtype=float), codes)[0]
+        equation = get_equation(y_name, x_array) + ' - 1'
+        n_absorbed = codes.max() + 1
+        ddof_scale = len(x_array) + n_absorbed
+    elif fixed_effect != '':
         figsize = (10,14)
 
-    model = smf.gee(equation, data=df, groups=groups, family=fam, cov_struct=cov)    
+    def fit_gee():
+        model = smf.gee(equation, data=df, groups=groups, family=fam, cov_struct=cov)    
+        results = model.fit(ddof_scale=ddof_scale)
+        qic = results.qic(results.scale)
+        return (CachedFit(results) if b_cache else results), qic, str(cov.summary())
 
-    results = model.fit()    
-    (QIC, QICu) = results.qic(results.scale)
-    print('%s =\n%s\n%s\n%s %s QIC = %.4f, QICu = %.4f\n\n\n' % (
-           y_name, results.summary(), cov.summary(), family, cov_struct, QIC, QICu))
+    key = cache_utils.get_hash('perform_gee', df, equation, groups, family, cov_struct, ddof_scale) if b_cache else None
+    results, (QIC, QICu), cov_summary = cache_utils.cached_call(key, fit_gee, b_cache)
+    #QICu penalizes 2 per parameter, including the absorbed intercepts (as in the dummy fit)
+    QICu += 2 * n_absorbed
+    log('%s =\n%s\n%s\n%s %s QIC = %.4f, QICu = %.4f\n\n\n' % (
+           y_name, results.summary(), cov_summary, family, cov_struct, QIC, QICu))
         
-    df_coef = results.params.to_frame().rename(columns={0: 'coef'})
-    figsize_gee = figsize
-    if df_coef.shape[0] < 3:
-        figsize_gee = (10, max(1, df_coef.shape[0]//2))   
-    ax = df_coef.plot.barh(figsize=figsize_gee)
-    ax.axvline(0, color='black', lw=1)
-    if x_lim != None:
-        ax.set_xlim(x_lim)
-    plt.grid(True)
-    title = y_name + ' using GEE ' + family + ' ' + cov_struct
-    plt.title(title)
+    if b_plot:
+        df_coef = results.params.to_frame().rename(columns={0: 'coef'})
+        figsize_gee = figsize
+        if df_coef.shape[0] < 3:
+            figsize_gee = (10, max(1, df_coef.shape[0]//2))   
+        plot_coefficients(df_coef, y_name + ' using GEE ' + family + ' ' + cov_struct, figsize_gee, x_lim)
+    return results
+
+def get_model_spec(spec):
+    #Fill in the defaults of a model sweep spec
+    #spec keys: model ('gee', 'ols' or 'mixedlm'), y_name, x_names, fixed_effect, family, cov_struct,
+    #b_within (absorb fixed_effect by demeaning) and b_intercepts (add the recovered within intercepts)
+    full_spec = {'model':'gee', 'fixed_effect':'', 'family':'Gaussian', 'cov_struct':'Exchangeable',
+                 'b_within':False, 'b_intercepts':False}
+    full_spec.update(spec)
+    full_spec['x_names'] = list(full_spec['x_names'])
+    if full_spec['b_within'] and (full_spec['model'] == 'mixedlm'):
+        #Random group intercepts are not identified on data demeaned within the same groups
+        raise ValueError('b_within is not supported for model = mixedlm')
+    family = full_spec['family'] if full_spec['model'] == 'gee' else 'Gaussian'
+    full_spec['b_within'] = check_within(full_spec['b_within'], full_spec['fixed_effect'], family)
+    return full_spec
+
+def save_design(data_path, endog, exog, groups, fixed_effects=None):
+    #Write one design to data_path as a (rows x (2 + exog columns)) array of group codes, endog and exog
+    #If fixed_effects is given, endog and exog are demeaned within fixed_effects groups first
+    #Return the fixed effect ids and their means (None without fixed effects), used for the intercepts
+    fixed_effect_ids, means = None, None
+    if fixed_effects is not None:
+        fixed_effect_ids, codes = np.unique(fixed_effects, return_inverse=True)
+        values, means = within_transform(np.column_stack([endog, exog]), codes)
+        endog, exog = values[:, 0], values[:, 1:]
+    group_codes = np.unique(groups, return_inverse=True)[1]
+    np.save(data_path, np.column_stack([group_codes, endog, exog]))
+    return fixed_effect_ids, means
+
+def fit_design(data_path, term_names, spec_index, spec, fixed_effect_ids=None, means=None):
+    #Fit one spec on a design written by save_design (memory-mapped, shared by all the specs of the design)
+    #With fixed effects, the degrees of freedom account for the absorbed group intercepts
+    #Return the tidy coefficient rows of the fit
+    data = np.load(data_path, mmap_mode='r')
+    groups, endog, exog = np.array(data[:, 0]), np.array(data[:, 1]), np.array(data[:, 2:])
+    n_absorbed = 0 if fixed_effect_ids is None else len(fixed_effect_ids)
+    rows = []
+    qic, qicu = np.nan, np.nan
+    if spec['model'] == 'ols':
+        model = sm.OLS(endog, exog)
+        if n_absorbed > 0:
+            model.df_resid = exog.shape[0] - exog.shape[1] - n_absorbed
+            model.df_model = exog.shape[1] + n_absorbed - 1
+        results = model.fit()
+        params, bse, pvalues = results.params, results.bse, results.pvalues
+    elif spec['model'] == 'mixedlm':
+        results = sm.MixedLM(endog, exog, groups=groups).fit()
+        k_fe = exog.shape[1]
+        params, bse, pvalues = results.fe_params, results.bse_fe, results.pvalues[:k_fe]
+    else:
+        _, fam = get_family(spec['family'])
+        _, cov = get_cov_struct(spec['cov_struct'])
+        results = sm.GEE(endog, exog, groups=groups, family=fam, cov_struct=cov).fit(ddof_scale=exog.shape[1] + n_absorbed)
+        params, bse, pvalues = results.params, results.bse, results.pvalues
+        (qic, qicu) = results.qic(results.scale)
+        qicu += 2 * n_absorbed
+    for i, term in enumerate(term_names):
+        rows.append({'spec':spec_index, 'term':term, 'coef':params[i], 'std_err':bse[i],
+                     'p_value':pvalues[i], 'qic':qic, 'qicu':qicu})
+    if (n_absorbed > 0) and spec['b_intercepts']:
+        intercepts = means[:, 0] - means[:, 1:] @ np.asarray(params)
+        for fixed_effect_id, intercept in zip(fixed_effect_ids, intercepts):
+            rows.append({'spec':spec_index, 'term':'intercept[%s]' % fixed_effect_id, 'coef':intercept,
+                         'std_err':np.nan, 'p_value':np.nan, 'qic':qic, 'qicu':qicu})
+    return rows
+
+def run_model_sweep(df, specs, groups_name='Subject ID', n_jobs=1, b_plot=False, x_lim=None):
+    #Fit a grid of GEE/OLS/MixedLM specs (see get_model_spec) on the same data
+    #Each distinct design matrix (y_name, x_names, fixed_effect) is built once and written to a
+    #memory-mapped file, and every spec is a separate job for the n_jobs worker processes
+    #Return a tidy table with one row per (spec, term)
+    df = df.dropna()
+    df = df.replace({True: 1, False: 0})
+    df = df.reset_index()
+    df.columns = [update_name(x) for x in df.columns]
+    groups = update_name(groups_name)
+    specs = [get_model_spec(spec) for spec in specs]
+    for spec in specs:
+        spec['family'] = get_family(spec['family'])[0]
+        spec['cov_struct'] = get_cov_struct(spec['cov_struct'])[0]
+    designs = collections.OrderedDict()
+    for spec_index, spec in enumerate(specs):
+        key = (spec['y_name'], tuple(spec['x_names']), spec['fixed_effect'], spec['b_within'])
+        designs.setdefault(key, []).append((spec_index, spec))
+    data_dir = tempfile.mkdtemp()
+    try:
+        jobs = []
+        for design_index, ((y_name, x_names, fixed_effect, b_within), fits) in enumerate(designs.items()):
+            if b_within:
+                y, X = dmatrices(get_equation(y_name, x_names) + ' - 1', df, return_type='dataframe')
+                fixed_effects = df.loc[X.index, update_name(fixed_effect)].values
+            else:
+                y, X = dmatrices(get_equation(y_name, x_names, fixed_effect), df, return_type='dataframe')
+                fixed_effects = None
+            data_path = os.path.join(data_dir, 'design_%d.npy' % design_index)
+            fixed_effect_ids, means = save_design(data_path, y.values[:, 0], X.values, df.loc[X.index, groups].values,
+                                                  fixed_effects)
+            for spec_index, spec in fits:
+                jobs.append((data_path, list(X.columns), spec_index, spec, fixed_effect_ids, means))
+        results = parallel_utils.run_parallel(fit_design, jobs, n_jobs)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    df_results = pd.DataFrame([row for rows in results for row in rows])
+    df_specs = pd.DataFrame(specs)
+    df_specs['x_names'] = [' + '.join(x) for x in df_specs['x_names']]
+    df_results = df_specs.join(df_results.set_index('spec'), how='inner')
+    df_results.index.name = 'spec'
+    if b_plot:
+        for spec_index, df_coef in df_results.groupby(level='spec'):
+            spec = specs[spec_index]
+            title = spec['y_name'] + ' using ' + spec['model'].upper()
+            if spec['model'] == 'gee':
+                title += ' ' + spec['family'] + ' ' + spec['cov_struct']
+            figsize = (10, max(1, min(14, df_coef.shape[0]//2)))
+            plot_coefficients(df_coef.set_index('term'), title, figsize, x_lim)
+    return df_results
 
-def perform_linear_regression(df, y_name, b_fixed_effect=False, x_lim=None):
+def perform_linear_regression(df, y_name, b_fixed_effect=False, x_lim=None, b_within=False, b_cache=False,
+                              b_plot=True):
     #Perform three linear regressions: OLS, GEE, Mixed Linear Model
+    #Set b_within = True (with b_fixed_effect) to absorb the Subject ID fixed effect by demeaning
+    #within participants instead of adding C(subject_id) dummies
+    #Set b_cache = True to reuse fits stored on disk (see cache_utils); the results are then CachedFit
     
     df = df.dropna()
     df = df.replace({True: 1, False: 0})
     df = df.reset_index()
 
-    plt.figure(figsize=(5,4))
-    plt.hist(df['Fitbit Step Count']) 
-    plt.xlabel('Fitbit Step Count')
-    plt.title('Fitbit Step Count histogram')
+    if b_plot:
+        plt.figure(figsize=(5,4))
+        plt.hist(df['Fitbit Step Count']) 
+        plt.xlabel('Fitbit Step Count')
+        plt.title('Fitbit Step Count histogram')
 
     df['Fitbit Log Step Count'] = np.log(df['Fitbit Step Count'] + 1e-7)
 
@@ -486,77 +1496,140 @@ def perform_linear_regression(df, y_name, b_fixed_effect=False, x_lim=None):
     y_display = y_name
     y_name = update_name(y_name)
     
+    x_names = ['busy', 'committed', 'rested', 'energetic',
+               'fatigued', 'happy', 'relaxed', 'sad', 'stressed', 'tense']
     equation  = " ~ busy + committed + rested + energetic"
     equation += " + fatigued + happy + relaxed + sad + stressed + tense"
 
     figsize = (10,3)
-    if b_fixed_effect:
+    n_absorbed = 0
+    if b_fixed_effect and b_within:
+        #Absorb the fixed effect on Subject ID by demeaning within participants
+        codes = pd.factorize(df['subject_id'])[0]
+        df[[y_name] + x_names] = within_transform(df[[y_name] + x_names].to_numpy(dtype=float), codes)[0]
+        equation += " - 1"
+        n_absorbed = codes.max() + 1
+    elif b_fixed_effect:
         #Add unconditional fixed effect on Subject ID
         equation += " + C(subject_id)"
         figsize = (10,14)
               
     model = y_name + equation
     
-    mod  = smf.ols(model, data=df)
-    res0 = mod.fit()
-    print('%s =\n%s\n\n\n' % (y_display, res0.summary()))
+    def fit_models():
+        mod  = smf.ols(model, data=df)
+        if n_absorbed > 0:
+            mod.df_resid = mod.exog.shape[0] - mod.exog.shape[1] - n_absorbed
+            mod.df_model = mod.exog.shape[1] + n_absorbed - 1
+        res0 = mod.fit()
+
+        cov = sm.cov_struct.Exchangeable()
+        mod = smf.gee(model, "subject_id", data=df, cov_struct=cov)    
+        res1 = mod.fit(ddof_scale=(mod.exog.shape[1] + n_absorbed) if n_absorbed > 0 else None)
+        qic = res1.qic(res1.scale)
+
+        mod = smf.mixedlm(model, df, groups=df['subject_id'])    
+        res2 = mod.fit()
+        if b_cache:
+            res0, res1, res2 = CachedFit(res0), CachedFit(res1), CachedFit(res2)
+        return res0, res1, res2, qic, str(cov.summary())
+
+    key = cache_utils.get_hash('perform_linear_regression', df, model, n_absorbed) if b_cache else None
+    res0, res1, res2, (QIC, QICu), cov_summary = cache_utils.cached_call(key, fit_models, b_cache)
+    QICu += 2 * n_absorbed
+    log('%s =\n%s\n\n\n' % (y_display, res0.summary()))
 
     fam_display = 'Gaussian'
     cov_display = 'Exchangeable'
-    cov = sm.cov_struct.Exchangeable()
-    mod = smf.gee(model, "subject_id", data=df, cov_struct=cov)    
-    res1 = mod.fit()    
-    (QIC, QICu) = res1.qic(res1.scale)
-    print('%s =\n%s\n%s\n%s %s QIC = %.4f, QICu = %.4f\n\n\n' % (
-           y_name, res1.summary(), cov.summary(), fam_display, cov_display, QIC, QICu))
-
-    mod = smf.mixedlm(model, df, groups=df['subject_id'])    
-    res2 = mod.fit()
-    print('%s =\n%s\n\n\n' % (y_display, res2.summary()))
-    
-    df_coef = res0.params.to_frame().rename(columns={0: 'coef'})
-    ax = df_coef.plot.barh(figsize=figsize)
-    ax.axvline(0, color='black', lw=1)
-    if x_lim != None:
-        ax.set_xlim(x_lim)
-    plt.grid(True)
-    plt.title(y_display + ' using OLS')
+    log('%s =\n%s\n%s\n%s %s QIC = %.4f, QICu = %.4f\n\n\n' % (
+           y_name, res1.summary(), cov_summary, fam_display, cov_display, QIC, QICu))
+
+    log('%s =\n%s\n\n\n' % (y_display, res2.summary()))
     
-    df_coef = res1.params.to_frame().rename(columns={0: 'coef'})
-    ax = df_coef.plot.barh(figsize=figsize)
-    ax.axvline(0, color='black', lw=1)
-    if x_lim != None:
-        ax.set_xlim(x_lim)
-    plt.grid(True)
-    plt.title(y_display + ' using GEE Regression')
+    if b_plot:
+        df_coef = res0.params.to_frame().rename(columns={0: 'coef'})
+        plot_coefficients(df_coef, y_display + ' using OLS', figsize, x_lim)
+        
+        df_coef = res1.params.to_frame().rename(columns={0: 'coef'})
+        plot_coefficients(df_coef, y_display + ' using GEE Regression', figsize, x_lim)
 
-    df_coef = res2.params[:len(res2.params)-1].to_frame().rename(columns={0: 'coef'})
-    ax = df_coef.plot.barh(figsize=figsize)
-    ax.axvline(0, color='black', lw=1)
-    if x_lim != None:
-        ax.set_xlim(x_lim)
-    plt.grid(True)
-    plt.title(y_display + ' using Mixed Linear Model Regression')
+        df_coef = res2.params[:len(res2.params)-1].to_frame().rename(columns={0: 'coef'})
+        plot_coefficients(df_coef, y_display + ' using Mixed Linear Model Regression', figsize, x_lim)
+    return res0, res1, res2
 
-def split_data(df, y_name, b_split_per_participant, split_percent=0.8, b_display=True):
+def get_classification_data(df, y_name):
+    #Drop missing rows and return the cleaned frame, the feature matrix and the targets
     df = df.dropna()
     df = df.replace({True: 1, False: 0})
+    df = df.drop(columns=['Fitbit Minutes Worn'])
+    X = df.drop(columns=y_name).to_numpy(dtype=float)
+    y = df[y_name].infer_objects().to_numpy()
+    return df, X, y
+
+def get_participant_positions(df):
+    #Position of each row within its participant and the participant's number of rows
+    codes = pd.factorize(df.index.get_level_values('Subject ID'))[0]
+    positions = df.groupby(level='Subject ID', sort=False).cumcount().to_numpy()
+    sizes = np.bincount(codes)[codes]
+    return codes, positions, sizes
+
+def get_split_masks(df, split_percent=0.8):
+    #Chronological train/test row masks per participant: the first round(split_percent * days)
+    #rows of each participant are used for training, the rest for testing
+    _, positions, sizes = get_participant_positions(df)
+    train_mask = positions < np.round(split_percent * sizes)
+    return train_mask, ~train_mask
+
+def get_cv_fold_ids(df, method='rolling', n_splits=5, random_state=0):
+    #Fold id of each row of df for cross validation (see get_cv_splits)
+    #For method = 'rolling' fold k trains on rows with fold id < k and tests on fold id == k,
+    #for method = 'group' fold k trains on rows with fold id != k and tests on fold id == k
+    codes, positions, sizes = get_participant_positions(df)
+    if method == 'rolling':
+        return np.floor(positions * (n_splits + 1) / sizes).astype(int)
+    elif method == 'group':
+        n_participants = codes.max() + 1 if len(codes) > 0 else 0
+        if n_splits > n_participants:
+            raise ValueError('group cross validation needs n_splits <= number of participants (%d > %d)' % (
+                             n_splits, n_participants))
+        rng = np.random.default_rng(random_state)
+        folds = np.arange(n_participants) % n_splits
+        rng.shuffle(folds)
+        return folds[codes]
+    raise ValueError('undefined cv method = %s' % method)
+
+def get_cv_folds(method, n_splits):
+    if method == 'rolling':
+        return list(range(1, n_splits+1))
+    return list(range(n_splits))
+
+def get_cv_masks(fold_ids, method, fold):
+    #Train/test row masks of one fold from the fold ids
+    test_mask = fold_ids == fold
+    if method == 'rolling':
+        return fold_ids < fold, test_mask
+    return ~test_mask, test_mask
+
+def get_cv_splits(df, method='rolling', n_splits=5, random_state=0):
+    #Generate (train index, test index) row positions of df for cross validation
+    #method = 'rolling': rolling-origin splits per participant, fold k trains on the first
+    #         k/(n_splits+1) of each participant's rows and tests on the following 1/(n_splits+1)
+    #method = 'group':   grouped k-fold, each participant is in the test set of exactly one fold
+    fold_ids = get_cv_fold_ids(df, method, n_splits, random_state)
+    for fold in get_cv_folds(method, n_splits):
+        train_mask, test_mask = get_cv_masks(fold_ids, method, fold)
+        yield np.flatnonzero(train_mask), np.flatnonzero(test_mask)
+
+def split_data(df, y_name, b_split_per_participant, split_percent=0.8, b_display=True):
+    df, X, y = get_classification_data(df, y_name)
     
     if b_split_per_participant:
-        df = df.drop(columns=['Fitbit Minutes Worn'])       
-        X = df.drop(columns=y_name)
-        y = df[y_name]        
-        X_train = X.groupby('Subject ID').apply(lambda x: x.head(round(split_percent * len(x))))
-        y_train = y.groupby('Subject ID').apply(lambda x: x.head(round(split_percent * len(x))))
-        X_test  = X.groupby('Subject ID').apply(lambda x: x.tail(len(x) - round(split_percent * len(x))))
-        y_test  = y.groupby('Subject ID').apply(lambda x: x.tail(len(x) - round(split_percent * len(x))))
-        X_train = X_train.values
-        y_train = y_train.values
+        train_mask, test_mask = get_split_masks(df, split_percent)
+        X_train = X[train_mask]
+        y_train = y[train_mask]
+        X_test  = X[test_mask]
+        y_test  = y[test_mask]
     else:
-        df = df.reset_index()
-        df = df.drop(columns=['Fitbit Minutes Worn', 'Subject ID', 'Date'])
-        X = df.drop(columns=y_name).values
-        y = df[y_name].values
         split = int(len(X) * split_percent)
         X_train = X[:split]
         y_train = y[:split]
@@ -564,289 +1637,480 @@ def split_data(df, y_name, b_split_per_participant, split_percent=0.8, b_display
         y_test  = y[split:]
 
     if b_display:
-        print('Classification for ' + y_name)
-        print('\ntrain split   = {}%'.format(int(split_percent*100)))
-        print('X_train.shape =', X_train.shape)
-        print('y_train.shape =', y_train.shape)
-        print('X_test.shape  =', X_test.shape)
-        print('y_test.shape  =', y_test.shape)
+        log('Classification for ' + y_name)
+        log('\ntrain split   = {}%'.format(int(split_percent*100)))
+        log('X_train.shape = %s' % (X_train.shape,))
+        log('y_train.shape = %s' % (y_train.shape,))
+        log('X_test.shape  = %s' % (X_test.shape,))
+        log('y_test.shape  = %s' % (y_test.shape,))
         
     return (X_train, y_train, X_test, y_test)
 
-def perform_classification(df, y_name, b_split_per_participant):    
+def perform_classification(df, y_name, b_split_per_participant, cv=None, n_splits=5):    
+    #Set cv = 'rolling' or 'group' to cross validate over the get_cv_splits folds
+    #instead of using a single train/test split
+    #Return the fold test accuracies (cv) or the fitted model with its train and test accuracy
+    if cv != None:
+        df, X, y = get_classification_data(df, y_name)
+        log('Classification for %s (%s cross validation, %d folds)' % (y_name, cv, n_splits))
+        test_scores = []
+        for fold, (train_index, test_index) in enumerate(get_cv_splits(df, cv, n_splits)):
+            model = LogisticRegression(solver='lbfgs', random_state=0)
+            model.fit(X[train_index], y[train_index])
+            test_scores.append(accuracy_score(y[test_index], model.predict(X[test_index])))
+            log('fold %d   train size = %d   test size = %d   test accuracy = %s' % (
+                   fold, len(train_index), len(test_index), test_scores[-1]))
+        log('\nmean test accuracy = %s\n' % np.mean(test_scores))
+        return {"test_scores":test_scores, "mean_test_accuracy":np.mean(test_scores)}
+    
     #Split the data and targets into training/testing sets
-    split_data_tuple = split_data(df, y_name, b_split_per_participant=True)
+    split_data_tuple = split_data(df, y_name, b_split_per_participant=b_split_per_participant)
     (X_train, y_train, X_test, y_test) = split_data_tuple
     
     model = LogisticRegression(solver='lbfgs', random_state=0)
     model.fit(X_train, y_train)
     y_predict = model.predict(X_test)
     
-    print('\nmodel =', model)
-    print('\ntrain accuracy = %s' % accuracy_score(y_train, model.predict(X_train)))
-    print('test  accuracy = %s\n' % accuracy_score(y_test,  model.predict(X_test)))
+    train_accuracy = accuracy_score(y_train, model.predict(X_train))
+    test_accuracy = accuracy_score(y_test, y_predict)
+    log('\nmodel = %s' % model)
+    log('\ntrain accuracy = %s' % train_accuracy)
+    log('test  accuracy = %s\n' % test_accuracy)
+    return {"model":model, "train_accuracy":train_accuracy, "test_accuracy":test_accuracy}
+
+def evaluate_classification_job(data_path, y_index, x_indices, fold_index, method, fold):
+    #Fit and evaluate one (y, features, fold) job on the shared read-only data matrix
+    start_time = timeit.default_timer()
+    data = np.load(data_path, mmap_mode='r')
+    train_mask, test_mask = get_cv_masks(data[:, fold_index], method, fold)
+    X = data[:, x_indices]
+    y = data[:, y_index]
+    result = {'n_train':int(train_mask.sum()), 'n_test':int(test_mask.sum()),
+              'train_accuracy':np.nan, 'test_accuracy':np.nan, 'status':'ok'}
+    #Degenerate folds (early rolling folds of a rare outcome, empty folds) get NaN metrics
+    if (result['n_train'] == 0) or (result['n_test'] == 0):
+        result['status'] = 'empty fold'
+    elif len(np.unique(y[train_mask])) < 2:
+        result['status'] = 'one class in train set'
+    else:
+        model = LogisticRegression(solver='lbfgs', random_state=0)
+        model.fit(X[train_mask], y[train_mask])
+        result['train_accuracy'] = accuracy_score(y[train_mask], model.predict(X[train_mask]))
+        result['test_accuracy'] = accuracy_score(y[test_mask], model.predict(X[test_mask]))
+    result['duration'] = timeit.default_timer() - start_time
+    return result
+
+def run_classification_grid(df, y_names, feature_sets, cv='rolling', n_splits=5, n_jobs=1, random_state=0):
+    #Evaluate every (y_name, feature set, fold) with LogisticRegression in n_jobs worker processes
+    #feature_sets is a dictionary of name -> feature columns, and cv = 'rolling' or 'group'
+    #(see get_cv_splits), or 'split' for the single 80/20 split per participant
+    #The data is written once to a memory-mapped file that all workers read, instead of
+    #sending the feature matrix with every job
+    #Return a tidy table with the metrics and the duration (seconds) of every job; jobs that cannot be
+    #fitted (empty fold or a single class in the train set) have NaN metrics and their reason in status
+    columns = list(y_names)
+    for features in feature_sets.values():
+        columns += [x for x in features if x not in columns]
+    df = df[columns].dropna()
+    df = df.replace({True: 1, False: 0})
+    if cv == 'split':
+        train_mask, _ = get_split_masks(df)
+        method, folds, fold_ids = 'rolling', [1], (~train_mask).astype(int)
+    else:
+        method, folds, fold_ids = cv, get_cv_folds(cv, n_splits), get_cv_fold_ids(df, cv, n_splits, random_state)
+    data = np.column_stack([df.to_numpy(dtype=float), fold_ids])
+    data_dir = tempfile.mkdtemp()
+    data_path = os.path.join(data_dir, 'classification_data.npy')
+    try:
+        np.save(data_path, data)
+        del data
+        keys = []
+        jobs = []
+        for y_name in y_names:
+            for features_name, features in feature_sets.items():
+                x_indices = [columns.index(x) for x in features if x != y_name]
+                for fold in folds:
+                    keys.append({'y_name':y_name, 'features':features_name, 'fold':fold})
+                    jobs.append((data_path, columns.index(y_name), x_indices, len(columns), method, fold))
+        results = parallel_utils.run_parallel(evaluate_classification_job, jobs, n_jobs)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return pd.DataFrame([dict(key, **result) for key, result in zip(keys, results)])
 
 def apply_threshold(df, threshold):
     #Extract data rows with Fitbit Minutes Worn > threshold
     #Add new column for Fitbit Minutes Worn > threshold in minutes, for example: 'Worn > 60 minutes'
     name = 'Worn > ' + str(threshold) + ' minutes'
-    df[name] = df['Fitbit Minutes Worn'].apply(lambda x: 1 if x > threshold else 0)    
+    df[name] = (df['Fitbit Minutes Worn'] > threshold).astype(int)
     df = df[df[name] == 1]
     return df
 
-def analyze_fitbit_worn_threshold(df, thresholds):
-    #Compute and plot Number of Participant vs. Minutes worn per day (steps > 0)
-    number_of_participants = []
-    steps_per_day = []
-    for threshold in thresholds:
-        name = 'Worn > ' + str(threshold) + ' minutes'
-        df_threshold = df.copy()
-        df_threshold = apply_threshold(df_threshold, threshold)
-        df_threshold = df_threshold[df_threshold['Fitbit Step Count'] == 0]
-        participants = list(set([x[0] for x in df_threshold['Fitbit Step Count'].index.values]))
-        n_participants = len(participants)
-        number_of_participants.append(n_participants)
-        print('%s\t(steps = 0)\tnumber of participants = %d' % (name, n_participants))
-        
+def get_worn_threshold_participants(df, thresholds):
+    #Number of participants with at least one day with Fitbit Minutes Worn > threshold and 0 steps,
+    #for every threshold: the maximum worn minutes on 0-step days of each participant are sorted once
+    #and all thresholds are answered with one searchsorted call; df can be a frame or a Panel
+    if isinstance(df, Panel):
+        worn = df.get('Fitbit Minutes Worn')
+        zero_steps = (df.get('Fitbit Step Count') == 0) & ~np.isnan(worn)
+        max_worn = np.sort(np.where(zero_steps, worn, -np.inf).max(axis=1)[zero_steps.any(axis=1)])
+        return len(max_worn) - np.searchsorted(max_worn, np.asarray(thresholds, dtype=float), side='right')
+    worn = df['Fitbit Minutes Worn']
+    worn = worn[(df['Fitbit Step Count'] == 0) & worn.notna()]
+    max_worn = np.sort(worn.groupby(level=0).max().to_numpy(dtype=float))
+    return len(max_worn) - np.searchsorted(max_worn, np.asarray(thresholds, dtype=float), side='right')
+
+def plot_worn_threshold(thresholds, number_of_participants):
     plt.figure(figsize=(4,3))
     plt.plot(thresholds, number_of_participants)
     plt.xlabel('Minutes worn per day (steps = 0)')
     plt.ylabel('Number of participants')
     plt.title('Fitbit Minutes Worn (steps = 0)')
 
-def get_xs_and_ys_average(data_dict):    
-    #xs = data_dict keys
-    #ys_mean = data_dict values average
-    #ys_ci_upper = data_dict values upper 95% confidence interval
-    #ys_ci_lower = data_dict values lower 95% confidence interval
-    xs = []
-    ys_mean = []
-    ys_ci_upper = []
-    ys_ci_lower = []
-    for key, y_values in data_dict.items():              
-        y_data = [y for y in y_values if str(y).lower() != 'nan']
-        if len(y_data) > 0:
-            xs.append(key)
-            mean_data = np.mean(y_data)
-            ys_mean.append(mean_data)
-            ys_ci_upper.append(mean_data + 1.96 * np.std(y_data) / np.sqrt(len(y_data)))
-            ys_ci_lower.append(mean_data - 1.96 * np.std(y_data) / np.sqrt(len(y_data)))
-    return xs, ys_mean, ys_ci_upper, ys_ci_lower
-
-def get_fitbit_step_per_day_of_week(df, participants, threshold, y_max=None):
-    #Compute and plot Mean Fitbit Step Count per Day of Week (worn threshold is in minutes)
-    group = df.groupby(by='Subject ID')
-    days_name = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+def analyze_fitbit_worn_threshold(df, thresholds, b_display=True, b_plot=True):
+    #Compute and plot Number of Participant vs. Minutes worn per day (steps > 0)
+    number_of_participants = get_worn_threshold_participants(df, thresholds).tolist()
+    if b_display:
+        for threshold, n_participants in zip(thresholds, number_of_participants):
+            name = 'Worn > ' + str(threshold) + ' minutes'
+            log('%s\t(steps = 0)\tnumber of participants = %d' % (name, n_participants))
+    if b_plot:
+        plot_worn_threshold(thresholds, number_of_participants)
+    return number_of_participants
+
+def get_participant_key_sums(df, participants, key_name, threshold, value_name='Fitbit Step Count'):
+    #Two-level (participant, key) sums, sums of squares and counts of value_name over the days
+    #with Fitbit Minutes Worn > threshold; key_name is 'Day of Week' or a column such as a mood
+    #(rounded to the nearest integer)
+    df = df[df.index.get_level_values('Subject ID').isin(participants)]
+    if key_name == 'Day of Week':
+        keys = pd.to_datetime(df.index.get_level_values('Date')).day_name().to_numpy(dtype=object)
+        valid_keys = pd.notna(keys)
+    else:
+        keys = np.round(df[key_name].to_numpy(dtype=float))
+        valid_keys = ~np.isnan(keys)
+    values = df[value_name].to_numpy(dtype=float)
+    mask = (df['Fitbit Minutes Worn'].to_numpy(dtype=float) > threshold) & ~np.isnan(values) & valid_keys
+    df_values = pd.DataFrame({'Subject ID':df.index.get_level_values('Subject ID')[mask], key_name:keys[mask],
+                              'value':values[mask], 'square':values[mask]**2})
+    return df_values.groupby(['Subject ID', key_name]).agg(sum=('value', 'sum'), sumsq=('square', 'sum'),
+                                                           count=('value', 'size'))
+
+def get_grouped_summary(df_sums, statistic='participant_mean', n_boot=0, alpha=0.05, random_state=0):
+    #Summarize (participant, key) sums per key with a normal 95% confidence interval and,
+    #if n_boot > 0, a cluster bootstrap over participants (n_boot resamples drawn at once)
+    #statistic = 'participant_mean': mean over participants of the participant means
+    #statistic = 'pooled_mean':      mean over all days of all participants
+    sums   = df_sums['sum'].unstack(fill_value=0.).to_numpy(dtype=float)
+    sumsq  = df_sums['sumsq'].unstack(fill_value=0.).to_numpy(dtype=float)
+    counts = df_sums['count'].unstack(fill_value=0).to_numpy(dtype=float)
+    keys = df_sums['sum'].unstack().columns
+    valid = counts > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if statistic == 'participant_mean':
+            values = np.where(valid, sums / counts, 0.)
+            n = valid.sum(axis=0)
+            mean = values.sum(axis=0) / n
+            std = np.sqrt(np.maximum((values**2).sum(axis=0) / n - mean**2, 0.))
+        else:
+            n = counts.sum(axis=0)
+            mean = sums.sum(axis=0) / n
+            std = np.sqrt(np.maximum(sumsq.sum(axis=0) / n - mean**2, 0.))
+        df_summary = pd.DataFrame({'n':n.astype(int), 'mean':mean,
+                                   'ci_lower':mean - 1.96 * std / np.sqrt(n),
+                                   'ci_upper':mean + 1.96 * std / np.sqrt(n)}, index=keys)
+        if n_boot > 0:
+            rng = np.random.default_rng(random_state)
+            n_participants = sums.shape[0]
+            weights = rng.multinomial(n_participants, np.full(n_participants, 1. / n_participants), size=n_boot)
+            if statistic == 'participant_mean':
+                boot = (weights @ values) / (weights @ valid)
+            else:
+                boot = (weights @ sums) / (weights @ counts)
+            df_summary['boot_lower'] = np.nanpercentile(boot, 100 * alpha / 2, axis=0)
+            df_summary['boot_upper'] = np.nanpercentile(boot, 100 * (1 - alpha / 2), axis=0)
+    return df_summary[df_summary['n'] > 0]
+
+def plot_step_summary(df_summary, threshold, n_participants, y_max=None):
+    #Plot the mean step count per key with the bootstrap interval (if computed) or the normal 95% ci
+    xs = list(df_summary.index)
+    lower, upper, label_ci = 'ci_lower', 'ci_upper', '95% ci'
+    if 'boot_lower' in df_summary:
+        lower, upper, label_ci = 'boot_lower', 'boot_upper', 'bootstrap ci'
     plt.figure(figsize=(5,4))
-    average_steps_all = collections.defaultdict(list)
-    for participant_id in participants:
-        df_individual = group.get_group(participant_id)
-        df_individual = df_individual.reset_index()    
-        df_individual['Date'] = pd.to_datetime(df_individual['Date'])
-        df_individual['Day of Week'] = df_individual['Date'].dt.day_name()
-        day_group = df_individual.groupby(by='Day of Week')
-        day_names_individual = [d for d in days_name if d in set(df_individual['Day of Week'].values)]
-        for day_name in day_names_individual:            
-            df_day = day_group.get_group(day_name).copy()
-            df_day = apply_threshold(df_day, threshold)
-            mean_individual = df_day['Fitbit Step Count'].mean()
-            average_steps_all[day_name].append(mean_individual)
-    xs, ys_mean, ys_ci_upper, ys_ci_lower = get_xs_and_ys_average(average_steps_all)   
-    plt.plot(xs, ys_mean, lw=2, label='mean', color='blue')
-    plt.fill_between(xs, ys_ci_lower, ys_ci_upper, color='b', alpha=.1, label='95% ci')
+    plt.plot(xs, df_summary['mean'].values, lw=2, label='mean', color='blue')
+    plt.fill_between(xs, df_summary[lower].values, df_summary[upper].values, color='b', alpha=.1, label=label_ci)
     label = 'Mean Step Count (worn > ' + str(threshold) + ' minutes)'
     plt.ylabel(label)
     title = 'Mean Fitbit Step Count (worn > ' + str(threshold) + ' minutes)\nper Participant'
-    title += ' (number of participants = ' + str(len(participants)) + ')'
+    title += ' (number of participants = ' + str(n_participants) + ')'
     plt.title(title)
-    plt.xticks(rotation=45)
     if y_max == None:
         y_max = 30000  
     plt.ylim((0,y_max))
-    plt.legend(loc=2, fontsize=8)
+
+def get_fitbit_step_per_day_of_week(df, participants, threshold, y_max=None, n_boot=0, b_plot=True):
+    #Compute and plot Mean Fitbit Step Count per Day of Week (worn threshold is in minutes)
+    days_name = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+    df_sums = get_participant_key_sums(df, participants, 'Day of Week', threshold)
+    df_summary = get_grouped_summary(df_sums, 'participant_mean', n_boot)
+    df_summary = df_summary.reindex([d for d in days_name if d in df_summary.index])
+    if b_plot:
+        plot_step_summary(df_summary, threshold, len(participants), y_max)
+        plt.xticks(rotation=45)
+        plt.legend(loc=2, fontsize=8)
+    return df_summary
         
-def get_fitbit_step_per_mood(df, participants, mood, threshold, y_max=None, x_lim=None):
+def get_fitbit_step_per_mood(df, participants, mood, threshold, y_max=None, x_lim=None, n_boot=0, b_plot=True):
     #Compute and plot Mean Fitbit Step Count per Mood (worn threshold is in minutes)
     threshold = min(threshold, 24*60)
-    group = df.groupby(by='Subject ID')
-    plt.figure(figsize=(5,4))
-    average_steps_all = collections.defaultdict(list)
-    data_plot = collections.defaultdict(list)
-    for participant_id in participants:
-        df_individual = group.get_group(participant_id)
-        df_individual = df_individual.reset_index()        
-        df_individual = apply_threshold(df_individual, threshold)
-        for i, x in enumerate(df_individual[mood]):
-            if str(x).lower() != 'nan':
-                x = round(x)
-                y = df_individual['Fitbit Step Count'].values[i]
-                average_steps_all[x].append(y)            
-    average_steps_all = collections.OrderedDict(sorted(average_steps_all.items()))
-    xs, ys_mean, ys_ci_upper, ys_ci_lower = get_xs_and_ys_average(average_steps_all)
-    plt.plot(xs, ys_mean, lw=2, label='mean', color='blue')
-    plt.fill_between(xs, ys_ci_lower, ys_ci_upper, color='b', alpha=.1, label='95% ci')
-    label = 'Mean Step Count (worn > ' + str(threshold) + ' minutes)'
-    plt.ylabel(label)
-    plt.xlabel(mood)
-    title = 'Mean Fitbit Step Count (worn > ' + str(threshold) + ' minutes)\nper Participant'
-    title += ' (number of participants = ' + str(len(participants)) + ')'
-    plt.title(title)
-    if y_max == None:
-        y_max = 30000
-    if x_lim == None:
-        x_lim = (1,5) 
-    plt.ylim((0,y_max))
-    plt.xlim(x_lim[0], x_lim[1])
-    plt.gca().xaxis.set_major_locator(mticker.MultipleLocator(1))
-    plt.legend(loc=2, fontsize=8)
+    df_sums = get_participant_key_sums(df, participants, mood, threshold)
+    df_summary = get_grouped_summary(df_sums, 'pooled_mean', n_boot).sort_index()
+    if b_plot:
+        plot_step_summary(df_summary, threshold, len(participants), y_max)
+        plt.xlabel(mood)
+        if x_lim == None:
+            x_lim = (1,5) 
+        plt.xlim(x_lim[0], x_lim[1])
+        plt.gca().xaxis.set_major_locator(mticker.MultipleLocator(1))
+        plt.legend(loc=2, fontsize=8)
+    return df_summary
+
+def get_fitbit_step_summaries(df, participants, key_names, thresholds, n_boot=1000, alpha=0.05, random_state=0):
+    #Step summaries for every (key, threshold) in one table indexed by (key name, threshold, key)
+    #key_names can contain 'Day of Week' (participant means) and mood columns (pooled over days)
+    days_name = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+    frames = {}
+    for key_name in key_names:
+        statistic = 'participant_mean' if key_name == 'Day of Week' else 'pooled_mean'
+        for threshold in thresholds:
+            df_sums = get_participant_key_sums(df, participants, key_name, min(threshold, 24*60))
+            df_summary = get_grouped_summary(df_sums, statistic, n_boot, alpha, random_state)
+            if key_name == 'Day of Week':
+                df_summary = df_summary.reindex([d for d in days_name if d in df_summary.index])
+            frames[(key_name, threshold)] = df_summary
+    return pd.concat(frames, names=['Key Name', 'Threshold', 'Key'])
+
+class LazyFrames(collections.abc.Mapping):
+    #Read-only dictionary that builds each frame with build_function(key) on first access
+    def __init__(self, keys, build_function):
+        self.keys_list = list(keys)
+        self.build_function = build_function
+        self.frames = {}
+
+    def __getitem__(self, key):
+        if key not in self.frames:
+            if key not in self.keys_list:
+                raise KeyError(key)
+            self.frames[key] = self.build_function(key)
+        return self.frames[key]
+
+    def __iter__(self):
+        return iter(self.keys_list)
+
+    def __len__(self):
+        return len(self.keys_list)
+
+def get_worn_day_counts(df, tH, column_sets):
+    #Number of days per (column set, participant, tH) where all columns of the set are observed and
+    #Fitbit Minutes Worn >= 60*tH. The worn minutes of each (column set, participant) are sorted once
+    #as one array of keys, and all thresholds are answered with a single searchsorted call
+    #With a Panel, the days are counted directly on the (participants x days) masks
+    thresholds = 60 * np.asarray(tH, dtype=float)
+    if isinstance(df, Panel):
+        worn = df.get('Fitbit Minutes Worn')
+        counts = []
+        for columns in column_sets:
+            complete = df.mask[:, :, df.get_indices(columns)].all(axis=2) & ~np.isnan(worn)
+            counts.append(((worn[:, :, None] >= thresholds) & complete[:, :, None]).sum(axis=1))
+        return df.participants, np.array(counts).reshape(len(column_sets), len(df), len(tH))
+    codes, participants = pd.factorize(df.index.get_level_values(0))
+    worn = df['Fitbit Minutes Worn'].to_numpy(dtype=float)
+    n_participants = len(participants)
+    n_segments = len(column_sets) * n_participants
+    segments = []
+    values = []
+    for g, columns in enumerate(column_sets):
+        complete = df[columns].notna().all(axis=1).to_numpy() & ~np.isnan(worn)
+        segments.append(g * n_participants + codes[complete])
+        values.append(worn[complete])
+    segments = np.concatenate(segments)
+    values = np.concatenate(values)
+    base = min(values.min() if len(values) > 0 else 0., thresholds.min())
+    scale = max(values.max() if len(values) > 0 else 0., thresholds.max()) - base + 1.
+    sorted_keys = np.sort(segments * scale + (values - base))
+    stops = np.searchsorted(sorted_keys, (np.arange(n_segments) + 1) * scale, side='left')
+    positions = np.searchsorted(sorted_keys, np.arange(n_segments)[:, None] * scale + (thresholds - base)[None, :], side='left')
+    counts = (stops[:, None] - positions).reshape(len(column_sets), n_participants, len(tH))
+    return participants, counts
+
+def build_available_data(tD, tH, df, participants, counts):
+    #Build the get_available_data output from the (participant x tH) day counts of one column set
+    valid = counts[None, :, :] >= np.asarray(tD)[:, None, None]
+    days = (counts[None, :, :] * valid).sum(axis=1)
+    df_days = pd.DataFrame(days, index=["tD=%d"%x for x in tD], columns=["tH=%s"%x for x in tH]).astype(float)
+    df_participants = pd.DataFrame(valid.sum(axis=1), index=["tD=%d"%x for x in tD], columns=["tH=%s"%x for x in tH]).astype(float)
+    #Participants kept in each frame are valid for td and all previous tD values
+    valid_cumulative = np.logical_and.accumulate(valid, axis=0)
+
+    def build_frame(key):
+        td, th = key
+        d = list(tD).index(td)
+        h = list(tH).index(th)
+        if isinstance(df, Panel):
+            df_all = df.select(participants=participants[valid_cumulative[d, :, h]]).to_frame()
+        else:
+            df_all = df[df.index.get_level_values(0).isin(participants[valid_cumulative[d, :, h]])].copy()
+        df_all['worn>'+str(th)] = df_all['Fitbit Minutes Worn'][df_all['Fitbit Minutes Worn'] >= 60*th]
+        return df_all.dropna()
 
-def get_available_data(tD, tH, df):
-    
     tDmin = min(tD)
     tHmin = min(tH)
-    
-    #Set tdmin and thmin to compute the fractions    
-    df_days=pd.DataFrame(np.zeros((len(tD),len(tH))),index=["tD=%d"%x for x in tD],
-                         columns=["tH=%s"%x for x in tH])
-    df_participants=pd.DataFrame(np.zeros((len(tD),len(tH))),index=["tD=%d"%x for x in tD], 
-                                 columns=["tH=%s"%x for x in tH])
-    participants = list(set([p for (p, date) in df.index.values]))
-    available_dict = {}
-    for th in tH:
-        key = 'worn>'+str(th)
-        df_all = df.copy()
-        df_all[key] = df_all['Fitbit Minutes Worn'][df_all['Fitbit Minutes Worn'] >= 60*th]
-        group = df_all.groupby(by='Subject ID')      
-        for td in tD:           
-            count = 0
-            count_days = 0
-            count_participants = 0
-            valid_participants = []
-            for participant in participants:
-                df_individual = group.get_group(participant)
-                df_individual = df_individual.dropna()
-                count = df_individual[key].shape[0]                
-                if count >= td:
-                    count_days += count
-                    count_participants += 1
-                    valid_participants.append(participant)
-            df_days.loc['tD='+str(td), 'tH='+str(th)] = int(count_days)
-            df_participants.loc['tD='+str(td), 'tH='+str(th)] = int(count_participants)
-            index_names = df_all.index.names
-            df_all = df_all.reset_index()
-            df_all = df_all[df_all['Subject ID'].isin(valid_participants)]
-            df_all = df_all.set_index(index_names)           
-            available_dict[(td, th)] = df_all.dropna()
-
     df_days_normalized = df_days / df_days.loc['tD='+str(tDmin), 'tH='+str(tHmin)]
     df_participants_normalized = df_participants / df_participants.loc['tD='+str(tDmin), 'tH='+str(tHmin)]
-    
     out=  {"dfdays":df_days.astype(int), 
            "dfparticipants":df_participants.astype(int),
-           "dfdata": available_dict, 
+           "dfdata":LazyFrames([(td, th) for th in tH for td in tD], build_frame),
            "dfdaysnorm":df_days_normalized,
            "dfparticipantsnorm":df_participants_normalized}
-           
     return out
 
+def get_available_data(tD, tH, df):
+    #Number of days and participants with at least td days where all columns are observed
+    #and Fitbit Minutes Worn >= 60*th, for every (td, th); dfdata frames are built on first access
+    #df can be a frame or a Panel
+    columns = df.variables if isinstance(df, Panel) else list(df.columns)
+    participants, counts = get_worn_day_counts(df, tH, [columns])
+    return build_available_data(tD, tH, df, participants, counts[0])
+
+def get_available_data_per_behavior(tD, tH, df, behaviors):
+    #get_available_data for each behavior using only the Fitbit columns and the behavior,
+    #with the day counts of all behaviors computed in one call
+    fitbit_columns = ['Fitbit Step Count', 'Fitbit Minutes Worn']
+    column_sets = [fitbit_columns + [behavior] for behavior in behaviors]
+    participants, counts = get_worn_day_counts(df, tH, column_sets)
+    available_data = {}
+    for g, behavior in enumerate(behaviors):
+        df_behavior = df.select(variables=column_sets[g]) if isinstance(df, Panel) else df[column_sets[g]]
+        available_data[behavior] = build_available_data(tD, tH, df_behavior, participants, counts[g])
+    return available_data
+
+def compute_valid_correlations(df, behaviors, activities, th, td, participants=None):
+    #For every (participant, behavior, activity), use the days with Fitbit Minutes Worn >= 60*th where
+    #both values are observed, and compute the number of days, the behavior/activity population
+    #standard deviations and the Pearson correlation (0 if either std is 0) in one grouped pass
+    #Results are (participant x behavior x activity) arrays; valid marks triples with at least td days
+    #df can be a frame or a Panel
+    columns = []
+    for col in list(behaviors) + list(activities):
+        if col not in columns:
+            columns.append(col)
+    if isinstance(df, Panel):
+        rows = np.arange(len(df))
+        if participants != None:
+            positions = {pid: p for p, pid in enumerate(df.participants)}
+            rows = np.array([positions[p] for p in participants if p in positions], dtype=int)
+        participant_ids = list(df.participants[rows])
+        X = df.get(columns)[rows]
+        X[~(df.get('Fitbit Minutes Worn')[rows] >= 60*th)] = np.nan
+    else:
+        df = df.sort_index(level='Subject ID')
+        blocks = get_participant_blocks(df)
+        if participants != None:
+            block_dict = {b[0]: b for b in blocks}
+            blocks = [block_dict[p] for p in participants if p in block_dict]
+        participant_ids = [b[0] for b in blocks]
+        values = df[columns].replace({True: 1, False: 0}).to_numpy(dtype=float, copy=True)
+        values[~(df['Fitbit Minutes Worn'].to_numpy(dtype=float) >= 60*th)] = np.nan
+        X = stack_blocks(values, blocks)
+    sums = get_grouped_correlation_sums(X)
+    b_index = [columns.index(x) for x in behaviors]
+    a_index = [columns.index(x) for x in activities]
+    n   = sums['n'][:, b_index][:, :, a_index]
+    sx  = sums['sx'][:, b_index][:, :, a_index]
+    sy  = sums['sx'].transpose(0, 2, 1)[:, b_index][:, :, a_index]
+    sxx = sums['sxx'][:, b_index][:, :, a_index]
+    syy = sums['sxx'].transpose(0, 2, 1)[:, b_index][:, :, a_index]
+    sxy = sums['sxy'][:, b_index][:, :, a_index]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_x = np.maximum(sxx / n - (sx / n)**2, 0.)
+        var_y = np.maximum(syy / n - (sy / n)**2, 0.)
+        #Treat rounding noise of a constant series as zero variance
+        var_x = np.where(var_x <= 1e-12 * (sxx / n), 0., var_x)
+        var_y = np.where(var_y <= 1e-12 * (syy / n), 0., var_y)
+        correlations = np.clip((sxy / n - (sx / n) * (sy / n)) / np.sqrt(var_x * var_y), -1., 1.)
+    correlations = np.where((var_x == 0.) | (var_y == 0.), 0., correlations)
+    counts = n.astype(int)
+    return {"participants":participant_ids, "counts":counts, "valid":(counts >= td) & (counts > 0),
+            "correlations":correlations, "behavior_stds":np.sqrt(var_x), "activity_stds":np.sqrt(var_y)}
+
+def plot_valid_correlations(correlations_dict):
+    #Scatter the correlation of every participant for each (activity, behavior), with the mean
+    plt.figure(figsize=(14,18))
+    plt.subplots_adjust(wspace=0.5, hspace=0.7)
+    for count, (k,v) in enumerate(sorted(correlations_dict.items())):
+        if count >= 24:
+            break
+        average_corr = round(np.nanmean(np.array(v), axis=0),3)
+        plt.subplot(6,4,count+1)
+        plt.scatter(range(len(v)), v, s=10, color='blue', alpha=.5)
+        plt.xlabel('sample')
+        plt.ylabel('correlation')
+        plt.title(str(k) + '\nmean corr = '+ str(average_corr))
+        plt.ylim(-.8,.8)
+        plt.axhline(y=0, ls=':', color='gray')
+        color='magenta'
+        if average_corr < 0:
+            color='green'
+        plt.axhline(y=average_corr, color=color)
+
+def plot_valid_correlation_histograms(correlations_dict, y_lim_hist=None):
+    #Histogram of the participant correlations for each (activity, behavior), with the mean
+    plt.figure(figsize=(14,18))
+    plt.subplots_adjust(wspace=0.5, hspace=0.8)
+    if y_lim_hist == None:
+        y_lim_hist = (0,44)
+    for count, (k,v) in enumerate(sorted(correlations_dict.items())):
+        if count >= 24:
+            break
+        average_corr = round(np.nanmean(np.array(v), axis=0),3)
+        plt.subplot(6,4,count+1)
+        bins = np.linspace(-0.75, 0.75, 16)
+        plt.hist(v, bins=bins, color='blue', alpha=.5)
+        plt.axvline(x=0, ls=':', color='gray')
+        color='magenta'
+        if average_corr < 0:
+            color='green'
+        plt.axvline(x=average_corr, color=color)
+        plt.ylim(y_lim_hist)
+        plt.title(str(k) + '\nmean corr = '+ str(average_corr))
+
 def get_correlations_average_within_valid_participant(df, behaviors, activities, yields, th, td, participants=None,
                                                       b_plot=False, b_hist=False, y_lim_hist=None):
     #yields[0] is the column name for "Num. Participants"
     #yields[1] is the column name for "Num. Days"
-    if participants == None:
-        participants = list(set([x[0] for x in df.index.values]))
-    if b_plot:
-        plt.figure(figsize=(14,18))
-        plt.subplots_adjust(wspace=0.5, hspace=0.7)
+    results = compute_valid_correlations(df, behaviors, activities, th, td, participants)
+    valid = results["valid"]
     df_correlation_averages=pd.DataFrame(np.zeros((len(behaviors),len(activities))), index=behaviors, columns=activities)
     df_yield_list = []
-    for activity in activities:
-        df_yield_list.append(pd.DataFrame(np.zeros((len(behaviors),len(yields))), index=behaviors, columns=yields))
+    for i, activity in enumerate(activities):
+        df_yield = pd.DataFrame(np.zeros((len(behaviors),len(yields))), index=behaviors, columns=yields)
+        df_yield[yields[0]] = valid[:, :, i].sum(axis=0)
+        df_yield[yields[1]] = np.where(valid[:, :, i], results["counts"][:, :, i], 0).sum(axis=0)
+        df_yield_list.append(df_yield.astype(int))
     correlations_dict = collections.defaultdict(list)
     behavior_stds_dict = collections.defaultdict(list)
-    
-    correlations_averages = {}
-    participants_averages = {}
-    days_averages = {}
-    count_all_valid = collections.defaultdict(int)
-    participants_all_valid = collections.defaultdict(int)
-    group = df.groupby(by='Subject ID')
-    for p, participant in enumerate(participants):
-        df_individual = group.get_group(participant)        
-        for behavior in behaviors:
-            for i, activity in enumerate(activities):                
-                df_corr = df_individual[[behavior, activity, 'Fitbit Minutes Worn']]
-                df_corr = df_corr[df_corr['Fitbit Minutes Worn'] >= 60*th]
-                df_corr = df_corr[[behavior, activity]]                        
-                df_corr = df_corr.dropna()
-                count = df_corr.shape[0]
-                if count >= td:
-                    data1 = df_corr[behavior]
-                    data2 = df_corr[activity]
-                    stdev_1 = np.array(data1).std()
-                    stdev_2 = np.array(data2).std()
-                    
-                    behavior_stds_dict[(activity,behavior)].append(stdev_1)
-                    
-                    if stdev_1 == 0. or stdev_2 == 0.:
-                        corr = 0.
-                    else:
-                        corr, _ = pearsonr(data1, data2)                    
-                    correlations_dict[(activity,behavior)].append(corr)
-                    participants_all_valid[((activity,behavior), yields[0])] += 1
-                    count_all_valid[((activity,behavior), yields[1])] += count
-                    if activity == activities[i]:
-                        df_yield_list[i].loc[behavior, yields[0]] = participants_all_valid[((activity,behavior), yields[0])]
-                        df_yield_list[i].loc[behavior, yields[1]] = count_all_valid[((activity,behavior), yields[1])]
-                        df_yield_list[i] = df_yield_list[i].astype(int)
-        if b_plot:
-            count = 0
-        for k,v in sorted(correlations_dict.items()):
-            average_corr = round(np.nanmean(np.array(v), axis=0),3)
-            correlations_averages[k] = average_corr
-            if b_plot:
-                xs = range(len(v))
-                subplot = count+1
-                if subplot <= 24:
-                    plt.subplot(6,4,subplot)
-                    plt.scatter(xs, v, s=10, color='blue', alpha=.5)
-                    plt.xlabel('sample')
-                    plt.ylabel('correlation')
-                    plt.title(str(k) + '\nmean corr = '+ str(average_corr))
-                    plt.ylim(-.8,.8)
-                    plt.axhline(y=0, ls=':', color='gray')
-                    if p == (len(participants)-1):
-                        color='magenta'
-                        if average_corr < 0:
-                            color='green'
-                        plt.axhline(y=average_corr, color=color)
-                count += 1
+    for j, behavior in enumerate(behaviors):
+        for i, activity in enumerate(activities):
+            if valid[:, j, i].any():
+                correlations_dict[(activity,behavior)] = list(results["correlations"][valid[:, j, i], j, i])
+                behavior_stds_dict[(activity,behavior)] = list(results["behavior_stds"][valid[:, j, i], j, i])
+    for k,v in sorted(correlations_dict.items()):
+        df_correlation_averages.loc[k[1],k[0]] = round(np.nanmean(np.array(v), axis=0),3)
+    if b_plot:
+        plot_valid_correlations(correlations_dict)
     if b_hist:
-        count = 0
-        plt.figure(figsize=(14,18))
-        plt.subplots_adjust(wspace=0.5, hspace=0.8)
-        for k,v in sorted(correlations_dict.items()):
-            average_corr = round(np.nanmean(np.array(v), axis=0),3)          
-            subplot = count+1
-            if subplot <= 24:
-                plt.subplot(6,4,subplot)
-                bins = np.linspace(-0.75, 0.75, 16)
-                plt.hist(v, bins=bins, color='blue', alpha=.5)                
-                plt.axvline(x=0, ls=':', color='gray')
-                color='magenta'
-                if average_corr < 0:
-                    color='green'
-                plt.axvline(x=average_corr, color=color)
-                if y_lim_hist == None:
-                    y_lim_hist = (0,44)
-                plt.ylim(y_lim_hist)
-                title = str(k) + '\nmean corr = '+ str(average_corr)              
-                plt.title(title)
-            count += 1
+        plot_valid_correlation_histograms(correlations_dict, y_lim_hist)
     if b_plot or b_hist:
         plt.show()
-    for k,average_corr in correlations_averages.items():
-        df_correlation_averages.loc[k[1],k[0]] = average_corr  
-        
     results = {"average_correlations":df_correlation_averages, "raw_correlations":correlations_dict, "correlation_yield":df_yield_list,"raw_behavior_stds":behavior_stds_dict}          
     return results 
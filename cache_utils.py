@@ -0,0 +1,125 @@
+import os
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+#Disk cache location and size limit (in bytes), set with the environment variables
+#HEARTSTEPS_CACHE_DIR and HEARTSTEPS_CACHE_SIZE or by assigning these module variables
+cache_dir = os.environ.get('HEARTSTEPS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'heartsteps'))
+max_cache_size = int(os.environ.get('HEARTSTEPS_CACHE_SIZE', 2**30))
+
+def update_hash(h, item):
+    #Feed arrays by their raw bytes (plus dtype and shape), frames and series by their labels, dtypes
+    #and vectorized row hashes (values and index), and everything else by its repr
+    if isinstance(item, pd.DataFrame):
+        update_hash(h, [list(item.columns), [str(x) for x in item.dtypes], list(item.index.names)])
+        update_hash(h, get_row_hashes(item))
+    elif isinstance(item, pd.Series):
+        update_hash(h, [item.name, str(item.dtype), list(item.index.names)])
+        update_hash(h, get_row_hashes(item))
+    elif isinstance(item, np.ndarray):
+        h.update(str((item.dtype.str, item.shape)).encode())
+        if item.dtype == object:
+            h.update(repr(item.tolist()).encode())
+        else:
+            h.update(np.ascontiguousarray(item).view(np.uint8).data)
+    elif isinstance(item, dict):
+        for k in sorted(item, key=str):
+            update_hash(h, k)
+            update_hash(h, item[k])
+    elif isinstance(item, (list, tuple)):
+        h.update(('%s:%d' % (type(item).__name__, len(item))).encode())
+        for x in item:
+            update_hash(h, x)
+    else:
+        h.update(repr(item).encode())
+    h.update(b'|')
+
+def get_row_hashes(item):
+    #uint64 hash of every row of a frame or series, including its index label
+    try:
+        return pd.util.hash_pandas_object(item, index=True).to_numpy()
+    except TypeError:
+        #Unhashable values (for example lists in object columns) are hashed by their repr
+        return pd.util.hash_pandas_object(item.astype(str), index=True).to_numpy()
+
+def get_hash(*items):
+    #Stable hash of the input arrays and options, used as a cache key
+    h = hashlib.sha1()
+    for item in items:
+        update_hash(h, item)
+    return h.hexdigest()
+
+def get_cache_path(key, directory=None):
+    return os.path.join(directory or cache_dir, key + '.pkl')
+
+def load(key, directory=None):
+    #Return the value stored under key, or None; a hit marks the entry as recently used
+    path = get_cache_path(key, directory)
+    try:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        #Unreadable entry (interrupted write or incompatible package versions)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None
+    os.utime(path)
+    return value
+
+def save(key, value, directory=None, max_size=None, b_evict=True):
+    #Store value under key (written to a temporary file first, so readers never see partial entries)
+    directory = directory or cache_dir
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, get_cache_path(key, directory))
+    except BaseException:
+        #Remove the partial temporary file and re-raise the original error
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    if b_evict:
+        evict(directory, max_size)
+
+def evict(directory=None, max_size=None):
+    #Remove the least recently used entries until the cache takes at most max_size bytes
+    directory = directory or cache_dir
+    max_size = max_cache_size if max_size is None else max_size
+    if not os.path.isdir(directory):
+        return
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.pkl'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+
+def clear(directory=None):
+    evict(directory, max_size=0)
+
+def cached_call(key, function, b_cache=True):
+    #Return function(), stored on disk under key, or the value stored by a previous call
+    if b_cache:
+        value = load(key)
+        if value is not None:
+            return value
+    value = function()
+    if b_cache:
+        save(key, value)
+    return value
@@ -0,0 +1,93 @@
+import os
+import sys
+import importlib
+import subprocess
+
+#Modules that must not be loaded by importing a headless module such as data_utils or analysis_utils
+heavy_modules = ['matplotlib.pyplot', 'seaborn', 'statsmodels.api', 'statsmodels.tsa.api', 'sklearn.impute',
+                 'sklearn.linear_model', 'jax', 'numpyro', 'pystan', 'IPython', 'ipywidgets']
+
+class LazyModule:
+    #Stand-in for a module (or an attribute of a module, such as a function or class) that is
+    #imported on first attribute access or call, so importing this package stays cheap
+    #On load, the stand-in replaces itself with the real object in the namespace of the module
+    #that created it, so later uses there go straight to the real object. Only the first call goes
+    #through __call__, so a warning raised by that call is reported at this file instead of the caller
+    def __init__(self, module_name, attribute=None, namespace=None):
+        self.__dict__['_module_name'] = module_name
+        self.__dict__['_attribute'] = attribute
+        self.__dict__['_namespace'] = namespace
+        self.__dict__['_target'] = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            if self._attribute is not None:
+                target = getattr(target, self._attribute)
+            self.__dict__['_target'] = target
+            if self._namespace is not None:
+                for name, value in list(self._namespace.items()):
+                    if value is self:
+                        self._namespace[name] = target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self._module_name if self._attribute is None else self._module_name + '.' + self._attribute
+        return '<lazy %s%s>' % (name, '' if self._target is None else ' (loaded)')
+
+def lazy_import(module_name, attribute=None):
+    #lazy_import('matplotlib.pyplot') replaces import matplotlib.pyplot as plt,
+    #lazy_import('statsmodels.tsa.api', 'VAR') replaces from statsmodels.tsa.api import VAR
+    return LazyModule(module_name, attribute, sys._getframe(1).f_globals)
+
+def get_import_time(module_name):
+    #Cold import time (in seconds) of module_name in a fresh interpreter, and the heavy modules it loaded
+    code = ('import sys, time\n'
+            't = time.perf_counter()\n'
+            'import %s\n'
+            'print(time.perf_counter() - t)\n'
+            'print(",".join(m for m in %r if m in sys.modules))\n') % (module_name, heavy_modules)
+    #The child process finds this package through the directory that contains it
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [x for x in [env.get('PYTHONPATH')] if x])
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            env=env).stdout.split('\n')
+    return float(output[0]), [m for m in output[1].split(',') if m != '']
+
+def check_import_time(module_names=None, max_ratio=1.5, n_repeats=3):
+    #Import-time guard: each module must import in at most max_ratio times the time of pandas
+    #(best of n_repeats cold starts) and must not load any of heavy_modules
+    #Raises RuntimeError on a regression (also under python -O) and returns the measured times otherwise
+    #__name__ is '__main__' when run with python -m <package>.lazy_utils, the spec keeps the package
+    package = __spec__.parent if __spec__ is not None else (__package__ or '')
+    if module_names is None:
+        module_names = ['data_utils', 'analysis_utils', 'report_utils', 'vis_utils',
+                        'models_numpyro_utils', 'models_pystan_utils']
+    baseline = min(get_import_time('pandas')[0] for _ in range(n_repeats))
+    times = {'pandas':baseline}
+    for name in module_names:
+        full_name = package + '.' + name if package else name
+        results = [get_import_time(full_name) for _ in range(n_repeats)]
+        times[name] = min(t for t, _ in results)
+        loaded = results[0][1]
+        if len(loaded) > 0:
+            raise RuntimeError('%s imports %s at import time' % (name, ', '.join(loaded)))
+        if times[name] > max_ratio * baseline:
+            raise RuntimeError('%s takes %.2fs to import (pandas takes %.2fs)' % (name, times[name], baseline))
+    return times
+
+if __name__ == '__main__':
+    #Import-time check: python -m <package>.lazy_utils exits with status 1 on a regression
+    try:
+        times = check_import_time()
+    except RuntimeError as error:
+        sys.exit('import-time check failed: %s' % error)
+    for name, seconds in times.items():
+        print('%s\t%.3f seconds' % (name, seconds))
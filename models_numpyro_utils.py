@@ -1,22 +1,31 @@
 import os
-import matplotlib as mpl
+#Use the Agg backend without a display; matplotlib reads MPLBACKEND when pyplot is first imported
 if os.environ.get('DISPLAY','') == '':
-    mpl.use('Agg')
-import matplotlib.pyplot as plt
+    os.environ.setdefault('MPLBACKEND', 'Agg')
 from textwrap import wrap
 import collections
 import timeit
 from datetime import datetime
-import sklearn.metrics as sm
 import pandas as pd
 import numpy as np
-import jax.numpy as jnp
-from jax import ops, random
-import numpyro
-import numpyro.distributions as dist
-import numpyro.distributions.constraints as constraints
-from numpyro.infer import MCMC, NUTS, Predictive
-from numpyro.diagnostics import hpdi
+try:
+    from . import lazy_utils
+except ImportError:
+    import lazy_utils
+#Plotting, sklearn, jax and numpyro are imported on first use (see lazy_utils)
+plt = lazy_utils.lazy_import('matplotlib.pyplot')
+sm = lazy_utils.lazy_import('sklearn.metrics')
+jnp = lazy_utils.lazy_import('jax.numpy')
+ops = lazy_utils.lazy_import('jax.ops')
+random = lazy_utils.lazy_import('jax.random')
+numpyro = lazy_utils.lazy_import('numpyro')
+dist = lazy_utils.lazy_import('numpyro.distributions')
+constraints = lazy_utils.lazy_import('numpyro.distributions.constraints')
+MCMC = lazy_utils.lazy_import('numpyro.infer', 'MCMC')
+NUTS = lazy_utils.lazy_import('numpyro.infer', 'NUTS')
+Predictive = lazy_utils.lazy_import('numpyro.infer', 'Predictive')
+hpdi = lazy_utils.lazy_import('numpyro.diagnostics', 'hpdi')
+print_summary = lazy_utils.lazy_import('numpyro.diagnostics', 'print_summary')
 
 fig_size = (7,5)
 build_time = collections.defaultdict(list)
@@ -64,7 +73,7 @@ def plot_data_regression_lines(samples, title, df, x_name, y_name, x_lim=None, y
     #Plot regression lines
     xs = np.linspace(data_x.min(), data_x.max(), 100)
     a_samples  = samples['intercept']
-    b1_samples = samples[x_name]
+    b1_samples = samples['b_'+x_name]
     a_mean     = jnp.mean(a_samples)
     b1_mean    = jnp.mean(b1_samples)
     n_samples  = 1000
@@ -135,39 +144,46 @@ def plot_data_AR(title, y_test, y_pred, n_forecast, b_show=True):
         plt.savefig(title + '_predict.png')
     plt.close('all')
 
-def model_regression(df, y_name, x_names):
-    xs = jnp.array(df[x_names].values)
-    y_obs = df[y_name].values   
+def get_design_matrix(df, x_names):
+    #(rows x covariates) design matrix, converted once outside of the model
+    return jnp.asarray(df[x_names].to_numpy(dtype=np.float32))
+
+def get_coefficient_samples(samples, x_names):
+    #Map the coefficient vector samples 'beta' (samples x covariates) of model_regression
+    #to one 'b_<x_name>' entry per covariate
+    samples = dict(samples)
+    beta = samples.pop('beta')
+    for i, x_name in enumerate(x_names):
+        samples['b_'+x_name] = beta[:, i]
+    return samples
+
+def model_regression(X, y_name, y_obs=None):
+    #Linear regression on the design matrix X (see get_design_matrix): all coefficients
+    #are sampled as one vector in a plate and the mean is a single matmul
     mu = numpyro.sample('intercept', dist.Normal(0., 1000))
-    M = xs.shape[1]  
-    for i in range(M):
-        b_name = 'b_'+x_names[i]
-        bi = numpyro.sample(b_name, dist.Normal(0., 10.))
-        bxi = bi * xs[:,i]
-        mu = mu +  bxi        
+    with numpyro.plate('covariates', X.shape[1]):
+        beta = numpyro.sample('beta', dist.Normal(0., 10.))
+    mu = mu + X @ beta
     log_sigma = numpyro.sample('log_sigma', dist.Normal(0., 10.))    
     numpyro.sample(y_name, dist.Normal(mu, jnp.exp(log_sigma)), obs=y_obs)
 
-def model_impute(data1, df_data2, y_name, y_index, x_names, mapping, b_fill_daily, b_classify, y_obs=None):
+def model_impute(X, day_indices, nan_indices, x_names, y_name, b_classify, y_obs=None):
+    #X holds one row per day and one column per x_name (NaN where missing), day_indices maps each
+    #observation of y_name to its row of X and nan_indices[j] lists the missing rows of column j
     bias = numpyro.sample('intercept', dist.Normal(0, 10))
     linear_predictor = bias
-    for x_name in x_names:
-        if not b_fill_daily:
-            x_values = df_data2[x_name].values            
-            isnan = np.isnan(x_values)
-            x_nan_indices = np.nonzero(isnan)[0]
-            if len(x_nan_indices) > 0:        
-                x_mu = numpyro.sample(x_name+'_mu',     dist.Normal(0, 10).expand([1]))
-                x_log_sigma = numpyro.sample(x_name+'_log_sigma',  dist.Normal(0, 10).expand([1]))
-                x_impute = numpyro.sample(x_name+'_impute', dist.Normal(x_mu[x_nan_indices],
-                                          jnp.exp(x_log_sigma[x_nan_indices])).mask(False))            
-                x_values = ops.index_update(x_values, x_nan_indices, x_impute)
-                numpyro.sample(x_name, dist.Normal(x_mu, jnp.exp(x_log_sigma)), obs=x_values)
-                df_data2[x_name] = x_values
-                mapping[x_name] = df_data2[x_name].to_dict()
-        x_values = jnp.array([mapping[x_name][i] for i in list(data1[y_index])])               
+    for j, x_name in enumerate(x_names):
+        x_values = X[:, j]
+        n_nan = nan_indices[j].shape[0]
+        if n_nan > 0:
+            x_mu = numpyro.sample(x_name+'_mu',     dist.Normal(0, 10).expand([1]))
+            x_log_sigma = numpyro.sample(x_name+'_log_sigma',  dist.Normal(0, 10).expand([1]))
+            x_impute = numpyro.sample(x_name+'_impute', dist.Normal(x_mu[0],
+                                      jnp.exp(x_log_sigma[0])).expand([n_nan]).mask(False))
+            x_values = x_values.at[nan_indices[j]].set(x_impute)
+            numpyro.sample(x_name, dist.Normal(x_mu, jnp.exp(x_log_sigma)), obs=x_values)
         b_value  = numpyro.sample('b_'+x_name, dist.Normal(0., 10.))
-        linear_predictor += b_value * x_values
+        linear_predictor += b_value * x_values[day_indices]
     if b_classify:     
         numpyro.sample(y_name, dist.Bernoulli(logits=linear_predictor), obs=y_obs)
     else:
@@ -182,34 +198,59 @@ def model_AR(y_obs, K, y_matrix):
     log_sigma = numpyro.sample('log_sigma', dist.Normal(0., 10.)) 
     y_sample = numpyro.sample('obs', dist.Normal(mus, jnp.exp(log_sigma)), obs=y_obs)
         
+def model_simple_regressions(X, y_name, y_obs=None):
+    #Independent univariate regressions y ~ intercept[j] + b[j] * X[:, j], one per column of X,
+    #fitted together: every parameter is a vector over the covariates plate
+    with numpyro.plate('covariates', X.shape[1], dim=-1):
+        intercept = numpyro.sample('intercept', dist.Normal(0., 1000))
+        b = numpyro.sample('b', dist.Normal(0., 10.))
+        log_sigma = numpyro.sample('log_sigma', dist.Normal(0., 10.))
+        with numpyro.plate('data', X.shape[0], dim=-2):
+            obs = None if y_obs is None else jnp.broadcast_to(jnp.asarray(y_obs)[:, None], X.shape)
+            numpyro.sample(y_name, dist.Normal(intercept + b * X, jnp.exp(log_sigma)), obs=obs)
+
+def get_simple_regression_samples(samples, x_names):
+    #Split the samples of model_simple_regressions into one dictionary per covariate,
+    #with the keys of a univariate model_regression fit
+    return {x_name: {'intercept':samples['intercept'][:, j], 'b_'+x_name:samples['b'][:, j],
+                     'log_sigma':samples['log_sigma'][:, j]} for j, x_name in enumerate(x_names)}
+
 def fit_simple_regression_model_numpyro(df_data, y_name, x_names, x_lim=None, y_lim=None, y_mean_lim=None, b_show=True):
-    mcmcs = []
+    #Fit y_name vs each x_name (one regression per covariate) with a single batched MCMC run
+    #Return the samples of each regression by x_name
+    start_time_simple_regression = timeit.default_timer()
+    title = y_name + ' vs ' + str(x_names) + ' (simple regression models)'
+    print('fitting for %s...' % title)
+
+    #Fit model
+    rng_key = random.PRNGKey(0)
+    kernel = NUTS(model_simple_regressions)
+    mcmc = MCMC(kernel, num_warmup=500, num_samples=1000)
+    mcmc.run(rng_key, X=get_design_matrix(df_data, x_names), y_name=y_name, y_obs=df_data[y_name].values)
+    save_build_time(title, start_time_simple_regression)
+    fit_time = timeit.default_timer() - start_time_simple_regression
+    samples_dict = get_simple_regression_samples(mcmc.get_samples(), x_names)
+
     for x_name in x_names:
-        start_time_simple_regression = timeit.default_timer()
+        #The build_time entry of each covariate (as recorded by the separate fits) is its equal share
+        #of the batched fit plus its summary, next to the combined entry above
+        start_time_covariate = timeit.default_timer() - fit_time / len(x_names)
         title = y_name + ' vs ' + x_name + ' (regression model)'
-        print('fitting for %s...' % title)
+        samples = samples_dict[x_name]
 
-        #Fit model
-        rng_key = random.PRNGKey(0)
-        kernel = NUTS(model_regression)
-        mcmc = MCMC(kernel, num_warmup=500, num_samples=1000)
-        mcmc.run(rng_key, df=df_data, y_name=y_name, x_names=[x_name])
-        
         #Display summary
         print('\nsummary for %s =' % title)
-        mcmc.print_summary()
-        samples = mcmc.get_samples()                
+        print_summary(samples, group_by_chain=False)
         samples['sigma'] = jnp.exp(samples['log_sigma'])    
         ss = samples['sigma']
         print('sigma mean = %.2f\tstd = %.2f\tmedian = %.2f\tQ5%% = %.2f\tQ95%% = %.2f' % (
               np.mean(ss), np.std(ss), np.median(ss), np.quantile(ss, 0.05, axis=0), np.quantile(ss, 0.95, axis=0)))     
-        save_build_time(title, start_time_simple_regression)
+        save_build_time(title, start_time_covariate)
         
         #Plot
         plot_data_regression_lines(samples, title, df_data, x_name, y_name, x_lim, y_lim, b_show)
-        mcmcs.append(mcmc)
         print('\n\n\n')
-    return mcmcs   
+    return samples_dict   
     
 def fit_regression_model_numpyro(df_data, y_name, x_names, y_mean_lim=None, b_show=True):
     start_time_regression = timeit.default_timer()
@@ -220,12 +261,12 @@ def fit_regression_model_numpyro(df_data, y_name, x_names, y_mean_lim=None, b_sh
     rng_key = random.PRNGKey(0)
     kernel = NUTS(model_regression)
     mcmc = MCMC(kernel, num_warmup=500, num_samples=1000)
-    mcmc.run(rng_key, df=df_data, y_name=y_name, x_names=x_names)
+    mcmc.run(rng_key, X=get_design_matrix(df_data, x_names), y_name=y_name, y_obs=df_data[y_name].values)
 
-    #Display summary
+    #Display summary (beta[i] is the coefficient of x_names[i])
     print('\nsummary for %s =' % title)
     mcmc.print_summary()
-    samples = mcmc.get_samples()
+    samples = get_coefficient_samples(mcmc.get_samples(), x_names)
     samples['sigma'] = jnp.exp(samples['log_sigma']) 
     ss = samples['sigma']
     print('sigma mean = %.2f\tstd = %.2f\tmedian = %.2f\tQ5%% = %.2f\tQ95%% = %.2f' % (
@@ -294,27 +335,35 @@ def fit_with_missing_data(participant, length, b_fill_daily, b_classify, df_data
     df_data1, data1, df_data2, _ = prepare_data(df_data1, df_data2, y_name, y_index, x_names,
                                                 b_standardize, b_show=b_show)
     y_obs = df_data1[y_name].values
-    mapping = {}
     if b_fill_daily:
         df_data2[x_names] = df_data2[x_names].ffill().bfill()
-        mapping = df_data2[x_names].to_dict()
     print('df_data1.shape  =', df_data1.shape)
     print('df_data2.shape  =', df_data2.shape)
     
+    #Dense inputs of model_impute, prepared once: daily covariates, the daily row of each
+    #observation and the missing rows of each covariate (none once filled)
+    X = jnp.asarray(df_data2[x_names].values, dtype=jnp.float32)
+    day_indices = df_data2.index.get_indexer(data1[y_index])
+    if (day_indices < 0).any():
+        print('not enough data')
+        return []
+    day_indices = jnp.asarray(day_indices, dtype=jnp.int32)
+    nan_indices = [np.flatnonzero(np.isnan(df_data2[x_name].values)) for x_name in x_names]
+    model_args = dict(X=X, day_indices=day_indices, nan_indices=nan_indices, x_names=x_names,
+                      y_name=y_name, b_classify=b_classify)
+
     #Fit model
     title = get_title(participant, df_data1, df_data2, y_name, x_names, b_fill_daily, b_classify)
     print('%s start fitting %s...\n' % (datetime.now(), title))
     mcmc = MCMC(NUTS(model_impute), num_warmup=500, num_samples=1000) 
-    mcmc.run(random.PRNGKey(0), data1=data1, df_data2=df_data2, y_name=y_name, y_index=y_index,
-             x_names=x_names, mapping=mapping, b_fill_daily=b_fill_daily, b_classify=b_classify, y_obs=y_obs)
+    mcmc.run(random.PRNGKey(0), y_obs=y_obs, **model_args)
     if b_summary:
         mcmc.print_summary()
     samples = mcmc.get_samples()
     save_build_time(title, start_time)
 
     #Posterior predictive distribution
-    y_pred = Predictive(model_impute, samples)(random.PRNGKey(1), data1=data1, df_data2=df_data2, y_name=y_name, y_index=y_index,
-            x_names=x_names, mapping=mapping, b_fill_daily=b_fill_daily, b_classify=b_classify)[y_name]
+    y_pred = Predictive(model_impute, samples)(random.PRNGKey(1), **model_args)[y_name]
     if b_classify:
         y_pred = (y_pred.mean(axis=0) >= 0.5).astype(jnp.uint8)
         print('accuracy =', (y_pred == y_obs).sum() / y_obs.shape[0])
@@ -406,8 +455,8 @@ if __name__ == '__main__':
         #Analysis with Daily Metrics Data
         x_names = ['Committed', 'Busy', 'Rested']
         y_name = 'Fitbit Step Count'
-        mcmcs = fit_simple_regression_model_numpyro(chosen_df1 , y_name, x_names, y_lim=(-5000, 35000), x_lim=(0.5, 5.5),
-                                                    b_show=b_show)
+        samples_dict = fit_simple_regression_model_numpyro(chosen_df1 , y_name, x_names, y_lim=(-5000, 35000),
+                                                           x_lim=(0.5, 5.5), b_show=b_show)
         mcmc = fit_regression_model_numpyro(chosen_df1 , y_name, x_names, b_show=b_show)
         print('build_time numpyro (repeat=%d) = %s\n\n\n' % (repeat, dict(build_time)))    
         pd.DataFrame.from_dict(data=build_time, orient='index').to_csv('build_time_numpyro.csv', header=False)
@@ -416,7 +465,7 @@ if __name__ == '__main__':
         participants = ['105']
         y_name = 'steps'
         x_names = ['Committed', 'Busy', 'Rested']
-        mcmcs = fit_simple_regression_model_numpyro(chosen_df2, y_name, x_names, b_show=b_show)
+        samples_dict = fit_simple_regression_model_numpyro(chosen_df2, y_name, x_names, b_show=b_show)
         mcmc = fit_regression_model_numpyro(chosen_df2, y_name, x_names, b_show=b_show)
         print('build_time numpyro (repeat=%d) = %s\n\n\n' % (repeat, dict(build_time)))
         pd.DataFrame.from_dict(data=build_time, orient='index').to_csv('build_time_numpyro.csv', header=False)
@@ -4,12 +4,17 @@ import os.path
 from os import path
 import collections
 import timeit
-import pystan
 import pickle
-import matplotlib
-import matplotlib.pyplot as plt
-import seaborn as sns
 from textwrap import wrap
+try:
+    from . import lazy_utils
+except ImportError:
+    import lazy_utils
+#pystan and plotting are imported on first use (see lazy_utils)
+pystan = lazy_utils.lazy_import('pystan')
+matplotlib = lazy_utils.lazy_import('matplotlib')
+plt = lazy_utils.lazy_import('matplotlib.pyplot')
+sns = lazy_utils.lazy_import('seaborn')
 
 fig_size = (7,5)
 build_time = collections.defaultdict(list)
@@ -0,0 +1,26 @@
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+def get_n_jobs(n_jobs):
+    #n_jobs = -1 uses all CPUs, None or 1 runs in the current process
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
+
+def get_seed(random_state, key):
+    #Deterministic seed per job (for example per participant), independent of
+    #which worker runs the job or in which order the jobs finish
+    return (int(random_state) + zlib.crc32(str(key).encode())) % (2**32)
+
+def run_parallel(function, jobs, n_jobs=1):
+    #Run function(*job) for every job and return the results in job order
+    #function must be defined at module level so it can be sent to the worker processes
+    n_jobs = min(get_n_jobs(n_jobs), max(1, len(jobs)))
+    if n_jobs == 1:
+        return [function(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(function, *job) for job in jobs]
+        return [future.result() for future in futures]
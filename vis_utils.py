@@ -1,15 +1,23 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-import seaborn
 import os
 import zipfile
-from IPython.display import HTML, display, Markdown, Latex
-from ipywidgets import interact, interactive, fixed, interact_manual
-import ipywidgets as widgets
-import tabulate
 from . import data_utils
+from . import lazy_utils
+#Plotting, IPython and ipywidgets are imported on first use (see lazy_utils)
+plt = lazy_utils.lazy_import('matplotlib.pyplot')
+MaxNLocator = lazy_utils.lazy_import('matplotlib.ticker', 'MaxNLocator')
+seaborn = lazy_utils.lazy_import('seaborn')
+HTML = lazy_utils.lazy_import('IPython.display', 'HTML')
+display = lazy_utils.lazy_import('IPython.display', 'display')
+Markdown = lazy_utils.lazy_import('IPython.display', 'Markdown')
+Latex = lazy_utils.lazy_import('IPython.display', 'Latex')
+interact = lazy_utils.lazy_import('ipywidgets', 'interact')
+interactive = lazy_utils.lazy_import('ipywidgets', 'interactive')
+fixed = lazy_utils.lazy_import('ipywidgets', 'fixed')
+interact_manual = lazy_utils.lazy_import('ipywidgets', 'interact_manual')
+widgets = lazy_utils.lazy_import('ipywidgets')
+tabulate = lazy_utils.lazy_import('tabulate')
 
 def shorten_xlabels(this_ax, table, length_limit):
     selected_ticks = np.linspace(start=0, stop=(len(table)-1), endpoint=True, num=10, dtype=int)